@@ -0,0 +1,242 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cryptography
+from cryptography.fernet import Fernet
+
+from image_crypto_gui import SUITES, decrypt_file, encrypt_file
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MB = 1024 * 1024
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def write_random(path, size_mb):
+    with open(path, 'wb') as f:
+        for _ in range(int(size_mb)):
+            f.write(os.urandom(MB))
+        f.write(os.urandom(int((size_mb % 1) * MB)))
+
+
+def bench_parallel(tmp, key, args):
+    plain = os.path.join(tmp, "plain.bin")
+    enc = os.path.join(tmp, "plain.enc")
+    out = os.path.join(tmp, "plain.out")
+    write_random(plain, args.size)
+    cases = [
+        ("fernet (single shot)", {"container": "fernet"}, {}),
+        ("binary, 1 worker", {}, {}),
+        (f"binary, {args.workers} threads", {"workers": args.workers, "pool": "thread"},
+         {"workers": args.workers, "pool": "thread"}),
+        (f"binary, {args.workers} processes", {"workers": args.workers, "pool": "process"},
+         {"workers": args.workers, "pool": "process"}),
+    ]
+    print(f"{'mode':<28}{'encrypt MB/s':>14}{'decrypt MB/s':>14}{'size %':>10}")
+    for name, enc_options, dec_options in cases:
+        enc_time = timed(encrypt_file, plain, enc, key, repeat=args.repeat, **enc_options)
+        dec_time = timed(decrypt_file, enc, out, key, repeat=args.repeat, **dec_options)
+        overhead = 100.0 * os.path.getsize(enc) / os.path.getsize(plain)
+        print(f"{name:<28}{args.size / enc_time:>14.1f}{args.size / dec_time:>14.1f}{overhead:>10.1f}")
+
+
+def bench_suites(tmp, key, args):
+    plain = os.path.join(tmp, "plain.bin")
+    enc = os.path.join(tmp, "plain.enc")
+    out = os.path.join(tmp, "plain.out")
+    print(f"{'suite':<22}{'size MB':>10}{'encrypt MB/s':>14}{'decrypt MB/s':>14}")
+    for size in args.sizes:
+        write_random(plain, size)
+        for suite in SUITES:
+            enc_time = timed(encrypt_file, plain, enc, key, repeat=args.repeat, suite=suite)
+            dec_time = timed(decrypt_file, enc, out, key, repeat=args.repeat)
+            print(f"{suite:<22}{size:>10g}{size / enc_time:>14.1f}{size / dec_time:>14.1f}")
+
+
+# Modes of the full suite: encrypt_file options for each, plus whether the
+# mode holds the whole file in memory (and is skipped above --fernet-max).
+MODES = {
+    "fernet": ({"container": "fernet"}, True),
+    "streaming": ({}, False),
+    "compressed": ({"compression": "zlib"}, False),
+    "parallel": ({"workers": os.cpu_count() or 1, "pool": "thread"}, False),
+}
+# Maps every byte to its low 4 bits: random data that still compresses about
+# as well as a typical uncompressed photo.
+HALF_ENTROPY = bytes(b & 0x0f for b in range(256))
+
+
+def write_sample(path, size_mb):
+    with open(path, 'wb') as f:
+        left = int(size_mb * MB)
+        while left > 0:
+            f.write(os.urandom(min(MB, left)).translate(HALF_ENTROPY))
+            left -= MB
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (MB if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(times):
+    return {f"p{p}": round(percentile(times, p) * 1000, 3) for p in (50, 95, 99)} | {
+        "max": round(max(times) * 1000, 3)}
+
+
+def run_case(mode, plain, tmp, key, samples):
+    # Runs in a fresh process so peak RSS belongs to this case alone.
+    baseline = peak_rss_mb()
+    options, _ = MODES[mode]
+    enc = os.path.join(tmp, f"{mode}.enc")
+    out = os.path.join(tmp, f"{mode}.out")
+    decrypt_options = {k: v for k, v in options.items() if k in ("workers", "pool")}
+    enc_times, dec_times = [], []
+    for _ in range(samples):
+        started = time.perf_counter()
+        encrypt_file(plain, enc, key, **options)
+        enc_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        decrypt_file(enc, out, key, **decrypt_options)
+        dec_times.append(time.perf_counter() - started)
+    if os.path.getsize(out) != os.path.getsize(plain):
+        raise RuntimeError(f"{mode}: decrypted size does not match the input")
+    size_mb = os.path.getsize(plain) / MB
+    result = {
+        "encrypt_mb_s": round(size_mb * samples / sum(enc_times), 2),
+        "decrypt_mb_s": round(size_mb * samples / sum(dec_times), 2),
+        "encrypt_latency_ms": latency_summary(enc_times),
+        "decrypt_latency_ms": latency_summary(dec_times),
+        "output_ratio": round(os.path.getsize(enc) / max(1, os.path.getsize(plain)), 4),
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    for path in (enc, out):
+        os.remove(path)
+    return result
+
+
+def bench_full(tmp, key, args):
+    # Every mode at every size; small files get more samples so the latency
+    # percentiles mean something, large ones fewer so a run stays bounded.
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cryptography": cryptography.__version__,
+        "results": [],
+    }
+    plain = os.path.join(tmp, "plain.bin")
+    context = multiprocessing.get_context("spawn")
+    print(f"{'mode':<12}{'size MB':>10}{'n':>5}{'enc MB/s':>10}{'dec MB/s':>10}"
+          f"{'enc p95 ms':>12}{'dec p95 ms':>12}{'peak RSS MB':>13}")
+    for size in args.sizes:
+        write_sample(plain, size)
+        samples = max(1, min(args.samples, int(args.budget / size)))
+        for mode in args.modes:
+            if MODES[mode][1] and size > args.fernet_max:
+                report["results"].append({"mode": mode, "size_mb": size, "skipped": "above --fernet-max"})
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_case, mode, plain, tmp, key, samples).result()
+            report["results"].append({"mode": mode, "size_mb": size, "samples": samples} | result)
+            rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "n/a"
+            print(f"{mode:<12}{size:>10g}{samples:>5}{result['encrypt_mb_s']:>10.1f}{result['decrypt_mb_s']:>10.1f}"
+                  f"{result['encrypt_latency_ms']['p95']:>12.1f}{result['decrypt_latency_ms']['p95']:>12.1f}{rss:>13}")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def compare(args):
+    # Prints the change in MB/s per mode and size; exits 1 if anything got
+    # slower than the threshold.
+    with open(args.baseline) as f:
+        old = {(r["mode"], r["size_mb"]): r for r in json.load(f)["results"] if "skipped" not in r}
+    with open(args.current) as f:
+        new = {(r["mode"], r["size_mb"]): r for r in json.load(f)["results"] if "skipped" not in r}
+    regressions = 0
+    print(f"{'mode':<12}{'size MB':>10}{'encrypt':>10}{'decrypt':>10}{'peak RSS':>10}")
+    for case in sorted(old.keys() & new.keys()):
+        changes = []
+        for field in ("encrypt_mb_s", "decrypt_mb_s"):
+            change = 100.0 * (new[case][field] / old[case][field] - 1)
+            regressions += change < -args.threshold
+            changes.append(f"{change:+.1f}%")
+        if old[case]["peak_rss_mb"] and new[case]["peak_rss_mb"]:
+            changes.append(f"{100.0 * (new[case]['peak_rss_mb'] / old[case]['peak_rss_mb'] - 1):+.1f}%")
+        else:
+            changes.append("n/a")
+        print(f"{case[0]:<12}{case[1]:>10g}" + "".join(f"{c:>10}" for c in changes))
+    print(f"{regressions} throughput regressions beyond {args.threshold:g}%.")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for image_crypto_gui.")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, best time is reported (default: 3)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parallel = commands.add_parser("parallel", help="single-shot Fernet vs. the binary container on one or more cores")
+    parallel.add_argument("--size", type=float, default=256, help="test file size in MB (default: 256)")
+    parallel.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel workers (default: cores)")
+    suites = commands.add_parser("suites", help="MB/s of every cipher suite across file sizes")
+    suites.add_argument("--sizes", type=float, nargs="+", default=[0.1, 1, 16, 256],
+                        help="test file sizes in MB (default: 0.1 1 16 256)")
+    full = commands.add_parser("full", help="MB/s, peak RSS and latency percentiles of every mode, saved as JSON")
+    full.add_argument("--sizes", type=float, nargs="+", default=[0.01, 0.1, 1, 16, 256, 2048],
+                      help="test file sizes in MB (default: 0.01 0.1 1 16 256 2048)")
+    full.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES),
+                      help="modes to run (default: all)")
+    full.add_argument("--samples", type=int, default=50, help="most runs per case (default: 50)")
+    full.add_argument("--budget", type=float, default=1024,
+                      help="MB processed per case at most; larger files get fewer runs (default: 1024)")
+    full.add_argument("--fernet-max", type=float, default=512,
+                      help="largest size in MB for modes that load the whole file (default: 512)")
+    full.add_argument("--output", default="benchmark-results.json", help="JSON results file")
+    diff = commands.add_parser("compare", help="compare two JSON result files from 'full'")
+    diff.add_argument("baseline", help="results of the old version")
+    diff.add_argument("current", help="results of the new version")
+    diff.add_argument("--threshold", type=float, default=10, help="slowdown in %% that counts (default: 10)")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        return compare(args)
+    key = Fernet.generate_key()
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.command == "parallel":
+            bench_parallel(tmp, key, args)
+        elif args.command == "suites":
+            bench_suites(tmp, key, args)
+        else:
+            bench_full(tmp, key, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
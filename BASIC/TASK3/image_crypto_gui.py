@@ -1,8 +1,1259 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
-from cryptography.fernet import Fernet
+from tkinter import filedialog, messagebox, ttk
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from PIL import Image, ImageTk
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import io
+import json
+import lzma
+import mmap
 import os
+import queue
+import random
+import re
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# Streaming container layout:
+#   header     magic(4) version(1) suite(1) flags(1) compression(1) chunk_size(u32) salt(16)
+#   file key   only with FLAG_ENVELOPE: nonce(12) + random file key sealed under the key file
+#   thumbnail  only with FLAG_THUMBNAIL: length(u32) + sealed JPEG preview
+#   chunks     AEAD ciphertext + tag for every chunk_size bytes of plaintext
+# Each chunk is sealed under the file key (derived from the key file and the
+# salt in files without FLAG_ENVELOPE), with a nonce made of the chunk counter
+# and a "final" flag (STREAM construction),
+# and the header as associated data. Reordering, truncating or extending the
+# file therefore fails authentication. The last chunk may be empty. The
+# thumbnail uses its own nonce, so it can be decrypted without the chunks.
+# With compression set, the chunks hold the zlib/lzma stream of the file
+# rather than the file itself (compress-then-encrypt). Nothing but the wrapped
+# file key depends on the key file, so changing keys only rewrites that section.
+MAGIC = b"ICRY"
+# Fernet tokens are base64 text starting with version byte 0x80 ("gA...").
+FERNET_PREFIX = b"gAAAAA"
+CONTAINERS = ("binary", "fernet", "tiled")
+FORMAT_VERSION = 1
+SUITE_AES256GCM = 1
+SUITE_CHACHA20POLY1305 = 2
+# AES-GCM is fastest on CPUs with AES-NI/PMULL; ChaCha20-Poly1305 wins without them.
+SUITES = {"aes-256-gcm": SUITE_AES256GCM, "chacha20-poly1305": SUITE_CHACHA20POLY1305}
+AEADS = {SUITE_AES256GCM: AESGCM, SUITE_CHACHA20POLY1305: ChaCha20Poly1305}
+HEADER = struct.Struct(">4sBBBBI16s")
+CHUNK_SIZE = 1024 * 1024
+# Inputs at least this big are memory-mapped instead of read chunk by chunk;
+# output buffers are written out WRITEV_BUFFERS at a time.
+MMAP_THRESHOLD = 4 * CHUNK_SIZE
+WRITEV_BUFFERS = 16
+TAG_SIZE = 16
+NONCE_PREFIX = bytes(7)
+FLAG_THUMBNAIL = 0x01
+FLAG_ENVELOPE = 0x02
+KNOWN_FLAGS = FLAG_THUMBNAIL | FLAG_ENVELOPE
+WRAPPED_KEY_SIZE = 12 + 32 + TAG_SIZE
+SECTION_LENGTH = struct.Struct(">I")
+THUMBNAIL_NONCE = b"\xff" * 12
+THUMBNAIL_SIZE = (256, 256)
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "lzma": COMPRESSION_LZMA}
+# Formats that are already compressed: JPEG, PNG, GIF and WebP (RIFF....WEBP).
+PRECOMPRESSED_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+SAMPLE_SIZE = 64 * 1024
+MIN_SAMPLE_RATIO = 0.9
+PREVIEW_SIZE = (500, 500)
+
+# Tiled container layout (random access to image regions):
+#   header  HEADER with TILED_MAGIC (chunk_size holds the tile size), followed
+#           by TILED_POINTER: offset and length of the sealed tile index, and
+#           the wrapped file key as in the streaming container
+#   tiles   sealed PNG tiles of every zoom level; level n is at 1/2**n scale
+#   index   sealed JSON with the image mode and, per level, its size and the
+#           (offset, length) of each tile in row-major order
+# Tile nonces count tiles in write order and each tile's associated data binds
+# its (level, column, row), so tiles cannot be swapped. The pointer is written
+# last and authenticated together with the index.
+TILED_MAGIC = b"ICRT"
+TILE_SIZE = 512
+TILED_POINTER = struct.Struct(">QI")
+TILE_POSITION = struct.Struct(">BII")
+INDEX_NONCE = b"\xfe" * 12
+
+
+ContainerHeader = collections.namedtuple("ContainerHeader", "raw suite flags compression chunk_size salt")
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+def derive_file_key(key, salt, info=b"image-crypto stream"):
+    master = base64.urlsafe_b64decode(key)
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info)
+    return hkdf.derive(master)
+
+
+def wrap_file_key(key, salt, header, file_key):
+    nonce = os.urandom(12)
+    wrapping_key = derive_file_key(key, salt, b"image-crypto wrap")
+    return nonce + AESGCM(wrapping_key).encrypt(nonce, file_key, header)
+
+
+def unwrap_file_key(key, salt, header, wrapped):
+    wrapping_key = derive_file_key(key, salt, b"image-crypto wrap")
+    try:
+        return AESGCM(wrapping_key).decrypt(wrapped[:12], wrapped[12:], header)
+    except InvalidTag:
+        raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+
+
+def read_key_section(src, header):
+    # The wrapped file key that follows the header, or b"" in pre-envelope files.
+    if not header.flags & FLAG_ENVELOPE:
+        return b""
+    wrapped = src.read(WRAPPED_KEY_SIZE)
+    if len(wrapped) < WRAPPED_KEY_SIZE:
+        raise ValueError("Encrypted file is truncated.")
+    return wrapped
+
+
+def read_file_key(src, header, key):
+    wrapped = read_key_section(src, header)
+    if not wrapped:
+        return derive_file_key(key, header.salt)
+    return unwrap_file_key(key, header.salt, header.raw, wrapped)
+
+
+def chunk_nonce(index, final):
+    return NONCE_PREFIX + struct.pack(">IB", index, 1 if final else 0)
+
+
+def report_chunk(done, progress, cancel):
+    # Called between chunks: cancellation is checked before more work is done.
+    if cancel is not None and cancel.is_set():
+        raise OperationCancelled("Operation cancelled.")
+    if progress is not None:
+        progress(done)
+
+
+def iter_chunks(src, size, mapped=False):
+    # Yields (index, final, data); one chunk of look-ahead tells us which is last.
+    # With mapped=True, large regular files are memory-mapped and handed out as
+    # memoryview slices, which the ciphers read without an intermediate copy.
+    view = map_remaining(src) if mapped else None
+    if view is not None:
+        count = max(1, -(-len(view) // size))
+        for index in range(count):
+            yield index, index == count - 1, view[index * size:(index + 1) * size]
+        return
+    index = 0
+    chunk = src.read(size)
+    while True:
+        following = src.read(size)
+        final = not following
+        yield index, final, chunk
+        if final:
+            return
+        chunk = following
+        index += 1
+
+
+def map_remaining(src):
+    # Read-only memoryview of src from its current position to the end, or None
+    # for pipes, wrapped readers and files too small to be worth mapping.
+    try:
+        fd = src.fileno()
+        offset = src.tell()
+        info = os.fstat(fd)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(info.st_mode) or info.st_size - offset < MMAP_THRESHOLD:
+        return None
+    mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, "madvise"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return memoryview(mapping)[offset:]
+
+
+class VectorWriter:
+    # Collects output buffers and hands them to the OS together with writev(),
+    # without joining them first. dst must be unbuffered (buffering=0).
+    def __init__(self, raw):
+        self.raw = raw
+        self.buffers = []
+
+    def write(self, data):
+        self.buffers.append(data)
+        if len(self.buffers) >= WRITEV_BUFFERS:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        buffers = self.buffers
+        self.buffers = []
+        while buffers:
+            if hasattr(os, "writev"):
+                written = os.writev(self.raw.fileno(), buffers)
+            else:
+                written = self.raw.write(buffers[0])
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if written:
+                buffers[0] = memoryview(buffers[0])[written:]
+
+
+def preallocate(f, size):
+    # Reserves the output's blocks up front so the file system can lay it out
+    # in one piece; a no-op where posix_fallocate is missing or unsupported.
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def map_ordered(func, jobs, workers=1, pool="thread"):
+    # Runs func over jobs on a thread or process pool and yields results in job
+    # order. At most two jobs per worker are in flight, so memory stays bounded.
+    if workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+    executor = (ThreadPoolExecutor if pool == "thread" else ProcessPoolExecutor)(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for job in jobs:
+            pending.append(executor.submit(func, *job))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def seal_chunk(suite, file_key, header, index, final, chunk):
+    return AEADS[suite](file_key).encrypt(chunk_nonce(index, final), chunk, header)
+
+
+def open_chunk(suite, file_key, header, index, final, block):
+    if len(block) < TAG_SIZE:
+        raise ValueError("Encrypted file is truncated.")
+    try:
+        return AEADS[suite](file_key).decrypt(chunk_nonce(index, final), block, header)
+    except InvalidTag:
+        raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+
+
+def make_thumbnail(path):
+    # A small JPEG preview, or None when Pillow cannot read the input.
+    try:
+        with Image.open(path) as img:
+            img.draft("RGB", THUMBNAIL_SIZE)
+            img.thumbnail(THUMBNAIL_SIZE)
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "JPEG", quality=85)
+            return out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+class CompressingReader:
+    # File-like wrapper that hands out the compressed stream of raw in
+    # read(size) pieces, pulling only as much input as it needs.
+    def __init__(self, raw, compression, level=None):
+        self.raw = raw
+        if compression == COMPRESSION_ZLIB:
+            self.compressor = zlib.compressobj(-1 if level is None else level)
+        else:
+            self.compressor = lzma.LZMACompressor(preset=6 if level is None else level)
+        self.buffer = bytearray()
+        self.consumed = 0
+        self.eof = False
+
+    def read(self, size):
+        while len(self.buffer) < size and not self.eof:
+            data = self.raw.read(CHUNK_SIZE)
+            if data:
+                self.consumed += len(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        out = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return out
+
+
+class DecompressingWriter:
+    # Output is produced in CHUNK_SIZE pieces, so a highly compressible payload
+    # cannot blow up memory use.
+    def __init__(self, raw, compression):
+        self.raw = raw
+        self.compression = compression
+        if compression == COMPRESSION_ZLIB:
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = lzma.LZMADecompressor()
+
+    def write(self, data):
+        if self.decompressor.eof:
+            if data:
+                raise ValueError("Unexpected data after the compressed payload.")
+            return
+        if self.compression == COMPRESSION_ZLIB:
+            self.raw.write(self.decompressor.decompress(data, CHUNK_SIZE))
+            while self.decompressor.unconsumed_tail:
+                self.raw.write(self.decompressor.decompress(self.decompressor.unconsumed_tail, CHUNK_SIZE))
+        else:
+            self.raw.write(self.decompressor.decompress(data, CHUNK_SIZE))
+            while not self.decompressor.needs_input and not self.decompressor.eof:
+                self.raw.write(self.decompressor.decompress(b"", CHUNK_SIZE))
+
+    def finish(self):
+        if not self.decompressor.eof:
+            raise ValueError("Compressed payload is truncated.")
+
+
+def is_precompressed(head):
+    return head.startswith(PRECOMPRESSED_SIGNATURES) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+
+def choose_compression(src_path, compression):
+    # Skips compression for formats that are compressed already, and for data
+    # whose samples (start, middle, end) do not shrink by at least 10%.
+    if compression == "none":
+        return "none"
+    with open(src_path, 'rb') as src:
+        if is_precompressed(src.read(12)):
+            return "none"
+        size = os.fstat(src.fileno()).st_size
+        sample = bytearray()
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            src.seek(offset)
+            sample += src.read(SAMPLE_SIZE)
+    if sample and len(zlib.compress(bytes(sample), 1)) > len(sample) * MIN_SAMPLE_RATIO:
+        return "none"
+    return compression
+
+
+# thumbnail: optional JPEG bytes stored as a separately sealed section.
+# compression/level: "none", "zlib" or "lzma" with the library's level/preset;
+# the choice is recorded in the header.
+def encrypt_stream(src, dst, key, chunk_size=CHUNK_SIZE, progress=None, cancel=None, workers=1, pool="thread",
+                   suite="aes-256-gcm", thumbnail=None, compression="none", level=None):
+    suite = SUITES[suite]
+    compression = COMPRESSIONS[compression]
+    salt = os.urandom(16)
+    flags = FLAG_ENVELOPE | (FLAG_THUMBNAIL if thumbnail is not None else 0)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, suite, flags, compression, chunk_size, salt)
+    file_key = os.urandom(32)
+    dst.write(header)
+    dst.write(wrap_file_key(key, salt, header, file_key))
+    if thumbnail is not None:
+        length = SECTION_LENGTH.pack(len(thumbnail) + TAG_SIZE)
+        dst.write(length)
+        dst.write(AEADS[suite](file_key).encrypt(THUMBNAIL_NONCE, thumbnail, header + length))
+    reader = CompressingReader(src, compression, level) if compression else src
+    done = 0
+    report_chunk(done, progress, cancel)
+    # memoryview slices cannot be sent to worker processes, so mapping is only
+    # used when chunks stay in this process.
+    mapped = workers <= 1 or pool == "thread"
+    jobs = ((suite, file_key, header, index, final, chunk)
+            for index, final, chunk in iter_chunks(reader, chunk_size, mapped))
+    for sealed in map_ordered(seal_chunk, jobs, workers, pool):
+        dst.write(sealed)
+        done = reader.consumed if compression else done + len(sealed) - TAG_SIZE
+        report_chunk(done, progress, cancel)
+
+
+def read_header(src, expected_magic=MAGIC):
+    header = src.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError("Not an encrypted image container (header too short).")
+    magic, version, suite, flags, compression, chunk_size, salt = HEADER.unpack(header)
+    if magic != expected_magic:
+        raise ValueError("Not an encrypted image container.")
+    if (version != FORMAT_VERSION or suite not in AEADS or flags & ~KNOWN_FLAGS
+            or compression not in COMPRESSIONS.values()):
+        raise ValueError(f"Unsupported container version {version} / suite {suite} / flags {flags:#x} "
+                         f"/ compression {compression}.")
+    return ContainerHeader(header, suite, flags, compression, chunk_size, salt)
+
+
+def read_container_header(path):
+    with open(path, 'rb') as src:
+        return read_header(src)
+
+
+def read_thumbnail_section(src, header):
+    # Returns (length field, sealed thumbnail), or (b"", None) without one.
+    if not header.flags & FLAG_THUMBNAIL:
+        return b"", None
+    length = src.read(SECTION_LENGTH.size)
+    if len(length) < SECTION_LENGTH.size:
+        raise ValueError("Encrypted file is truncated.")
+    size = SECTION_LENGTH.unpack(length)[0]
+    sealed = src.read(size)
+    if size < TAG_SIZE or len(sealed) < size:
+        raise ValueError("Encrypted file is truncated.")
+    return length, sealed
+
+
+def load_thumbnail(path, key):
+    # Decrypts only the header and the embedded preview; None if there is none.
+    with open(path, 'rb') as src:
+        header = read_header(src)
+        if not header.flags & FLAG_THUMBNAIL:
+            return None
+        file_key = read_file_key(src, header, key)
+        length, sealed = read_thumbnail_section(src, header)
+    try:
+        return AEADS[header.suite](file_key).decrypt(THUMBNAIL_NONCE, sealed, header.raw + length)
+    except InvalidTag:
+        raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+
+
+def payload_offset(path):
+    # Offset of the first chunk in a binary container.
+    with open(path, 'rb') as src:
+        header = read_header(src)
+        wrapped = read_key_section(src, header)
+        length, sealed = read_thumbnail_section(src, header)
+    return len(header.raw) + len(wrapped) + len(length) + (len(sealed) if sealed else 0)
+
+
+def decrypt_stream(src, dst, key, progress=None, cancel=None, workers=1, pool="thread"):
+    header = read_header(src)
+    file_key = read_file_key(src, header, key)
+    length, sealed = read_thumbnail_section(src, header)
+    done = len(header.raw) + (WRAPPED_KEY_SIZE if header.flags & FLAG_ENVELOPE else 0)
+    done += len(length) + (len(sealed) if sealed else 0)
+    report_chunk(done, progress, cancel)
+    writer = DecompressingWriter(dst, header.compression) if header.compression else dst
+    mapped = workers <= 1 or pool == "thread"
+    jobs = ((header.suite, file_key, header.raw, index, final, block)
+            for index, final, block in iter_chunks(src, header.chunk_size + TAG_SIZE, mapped))
+    for chunk in map_ordered(open_chunk, jobs, workers, pool):
+        writer.write(chunk)
+        done += len(chunk) + TAG_SIZE
+        report_chunk(done, progress, cancel)
+    if header.compression:
+        writer.finish()
+
+
+def detect_container(path):
+    with open(path, 'rb') as f:
+        return container_kind(f.read(len(FERNET_PREFIX)))
+
+
+def container_kind(start):
+    if start.startswith(MAGIC):
+        return "binary"
+    if start.startswith(TILED_MAGIC):
+        return "tiled"
+    if start.startswith(FERNET_PREFIX):
+        return "fernet"
+    raise ValueError("Not an encrypted image file (unknown format).")
+
+
+def temp_output_path(dst_path):
+    return f"{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def remove_partial(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def fernet_encrypt_file(src_path, dst_path, key, progress=None, cancel=None):
+    # The original format: one base64 Fernet token for the whole file. It needs
+    # the file in memory and is about a third larger, but any Fernet
+    # implementation can read it.
+    with open(src_path, 'rb') as file:
+        original = file.read()
+    encrypted = Fernet(key).encrypt(original)
+    report_chunk(0, None, cancel)
+    with open(dst_path, 'wb') as enc_file:
+        enc_file.write(encrypted)
+    report_chunk(len(original), progress, None)
+
+
+def fernet_decrypt_file(src_path, dst_path, key, progress=None, cancel=None):
+    with open(src_path, 'rb') as enc_file:
+        encrypted = enc_file.read()
+    try:
+        decrypted = Fernet(key).decrypt(encrypted)
+    except InvalidToken:
+        raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+    report_chunk(0, None, cancel)
+    with open(dst_path, 'wb') as dec_file:
+        dec_file.write(decrypted)
+    report_chunk(len(encrypted), progress, None)
+
+
+# progress(done) receives the number of input bytes processed so far; cancel is
+# a threading.Event that aborts the job between chunks. workers > 1 seals the
+# chunks of one file in parallel on a "thread" or "process" pool. container is
+# "binary" (the chunked container) or "fernet" (legacy single token); suite
+# picks the binary container's cipher from SUITES and thumbnail embeds an
+# encrypted preview of image inputs. compression ("none", "zlib", "lzma") is
+# skipped automatically for inputs that would not shrink. Output goes to a
+# temporary file next to dst_path that replaces it only once complete, so a job
+# may overwrite its own input and a failed or cancelled job leaves dst_path as
+# it was.
+def encrypt_file(src_path, dst_path, key, chunk_size=CHUNK_SIZE, progress=None, cancel=None, workers=1, pool="thread",
+                 container="binary", suite="aes-256-gcm", thumbnail=False, compression="none", level=None):
+    tmp_path = temp_output_path(dst_path)
+    try:
+        if container == "fernet":
+            fernet_encrypt_file(src_path, tmp_path, key, progress, cancel)
+        elif container == "tiled":
+            encrypt_tiled(src_path, tmp_path, key, TILE_SIZE, progress, cancel, suite)
+        else:
+            with open(src_path, 'rb') as src, open(tmp_path, 'wb', buffering=0) as dst:
+                preview = make_thumbnail(src_path) if thumbnail else None
+                compression = choose_compression(src_path, compression)
+                if compression == "none":
+                    preallocate(dst, encrypted_size(os.fstat(src.fileno()).st_size, chunk_size) + WRAPPED_KEY_SIZE)
+                writer = VectorWriter(dst)
+                encrypt_stream(src, writer, key, chunk_size, progress, cancel, workers, pool, suite, preview,
+                               compression, level)
+                writer.flush()
+                dst.truncate(dst.tell())
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        remove_partial(tmp_path)
+        raise
+
+
+def decrypt_file(src_path, dst_path, key, progress=None, cancel=None, workers=1, pool="thread"):
+    container = detect_container(src_path)
+    tmp_path = temp_output_path(dst_path)
+    try:
+        if container == "fernet":
+            fernet_decrypt_file(src_path, tmp_path, key, progress, cancel)
+        elif container == "tiled":
+            # Only pixels are stored, so the full-resolution level is re-encoded.
+            img = decrypt_region(src_path, key)
+            known = Image.registered_extensions()
+            img.save(tmp_path, format=known.get(os.path.splitext(dst_path)[1].lower(), "PNG"))
+        else:
+            size = decrypted_size(src_path)
+            with open(src_path, 'rb') as src, open(tmp_path, 'wb', buffering=0) as dst:
+                preallocate(dst, size)
+                writer = VectorWriter(dst)
+                decrypt_stream(src, writer, key, progress, cancel, workers, pool)
+                writer.flush()
+                dst.truncate(dst.tell())
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        remove_partial(tmp_path)
+        raise
+
+
+class PrefixedReader:
+    # Puts bytes already read from a pipe back in front of it, so the format
+    # can be sniffed without seeking.
+    def __init__(self, prefix, raw):
+        self.prefix = prefix
+        self.raw = raw
+
+    def read(self, size):
+        if not self.prefix:
+            return self.raw.read(size)
+        out = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(out) < size:
+            out += self.raw.read(size - len(out))
+        return out
+
+
+# Pipes cannot be rewound, so only the binary container (header first, then
+# fixed-size chunks) can be written or read through them; memory use stays at
+# a few chunks whatever the input size.
+def encrypt_pipe(src, dst, key, workers=1, pool="thread", suite="aes-256-gcm", compression="none", level=None):
+    head = src.read(12)
+    if compression != "none" and is_precompressed(head):
+        compression = "none"
+    encrypt_stream(PrefixedReader(head, src), dst, key, CHUNK_SIZE, None, None, workers, pool, suite, None,
+                   compression, level)
+
+
+def decrypt_pipe(src, dst, key, workers=1, pool="thread"):
+    start = src.read(len(FERNET_PREFIX))
+    container = container_kind(start)
+    if container != "binary":
+        raise ValueError(f"The {container} format cannot be decrypted from a pipe; pass a file path instead.")
+    decrypt_stream(PrefixedReader(start, src), dst, key, None, None, workers, pool)
+
+
+def decrypt_to_memory(src_path, key, progress=None, cancel=None, workers=1, pool="thread"):
+    container = detect_container(src_path)
+    if container == "fernet":
+        with open(src_path, 'rb') as enc_file:
+            return Fernet(key).decrypt(enc_file.read())
+    if container == "tiled":
+        out = io.BytesIO()
+        decrypt_region(src_path, key).save(out, "PNG")
+        return out.getvalue()
+    out = io.BytesIO()
+    with open(src_path, 'rb') as src:
+        decrypt_stream(src, out, key, progress, cancel, workers, pool)
+    return out.getvalue()
+
+
+def open_preview(fp, size=PREVIEW_SIZE):
+    # Decode at reduced resolution where the format allows it: draft() makes
+    # libjpeg decode JPEGs at 1/2, 1/4 or 1/8 scale, and reduce() shrinks other
+    # formats by an integer factor before the final resampling.
+    img = Image.open(fp)
+    img.draft(None, size)
+    factor = min(img.width // size[0], img.height // size[1])
+    if factor > 1:
+        # reduce() rejects palette, bilevel and 16-bit modes.
+        img = tileable(img).reduce(factor)
+    img.thumbnail(size)
+    return img
+
+
+def tile_nonce(number):
+    return b"\x01" + bytes(6) + struct.pack(">IB", number, 0)
+
+
+# Modes tileable() converts without losing pixel data; others (16-bit, float,
+# CMYK, ...) would be squeezed into 8-bit RGB, so the tiled format refuses them.
+TILED_MODES = ("1", "L", "LA", "P", "PA", "RGB", "RGBA")
+
+
+def tileable(img):
+    # PNG tiles and reduce() both work on these modes.
+    if img.mode in ("L", "LA", "RGB", "RGBA"):
+        return img
+    has_alpha = "A" in img.getbands() or "transparency" in img.info
+    return img.convert("RGBA" if has_alpha else "RGB")
+
+
+def encrypt_tiled(src_path, dst_path, key, tile_size=TILE_SIZE, progress=None, cancel=None, suite="aes-256-gcm"):
+    # The source is decoded once; every later region read only touches its tiles.
+    # Only the level being written and the next smaller one are held in memory.
+    suite = SUITES[suite]
+    try:
+        img = Image.open(src_path)
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"{e} Split the image or use the binary format.") from None
+    with img:
+        if img.mode not in TILED_MODES:
+            raise ValueError(f"The tiled format stores 8-bit pixels only; this {img.mode} image would lose data. "
+                             f"Use the binary format instead.")
+        img.load()
+        layer = tileable(img)
+    sizes = [layer.size]
+    while max(sizes[-1]) > tile_size:
+        sizes.append((-(-sizes[-1][0] // 2), -(-sizes[-1][1] // 2)))
+    grids = [(-(-width // tile_size), -(-height // tile_size)) for width, height in sizes]
+    salt = os.urandom(16)
+    header = HEADER.pack(TILED_MAGIC, FORMAT_VERSION, suite, FLAG_ENVELOPE, 0, tile_size, salt)
+    file_key = os.urandom(32)
+    aead = AEADS[suite](file_key)
+    total_tiles = sum(columns * rows for columns, rows in grids)
+    src_size = os.path.getsize(src_path)
+    index = {"mode": layer.mode, "levels": []}
+    number = 0
+    with open(dst_path, 'wb') as dst:
+        dst.write(header)
+        dst.write(TILED_POINTER.pack(0, 0))
+        dst.write(wrap_file_key(key, salt, header, file_key))
+        for level, (columns, rows) in enumerate(grids):
+            if level:
+                layer = layer.reduce(2)
+            tiles = []
+            for row in range(rows):
+                for column in range(columns):
+                    report_chunk(src_size * number // total_tiles, progress, cancel)
+                    left, upper = column * tile_size, row * tile_size
+                    box = (left, upper, min(left + tile_size, layer.width), min(upper + tile_size, layer.height))
+                    out = io.BytesIO()
+                    layer.crop(box).save(out, "PNG", compress_level=1)
+                    sealed = aead.encrypt(tile_nonce(number), out.getvalue(),
+                                          header + TILE_POSITION.pack(level, column, row))
+                    tiles.append([dst.tell(), len(sealed)])
+                    dst.write(sealed)
+                    number += 1
+            index["levels"].append({"width": layer.width, "height": layer.height, "columns": columns, "tiles": tiles})
+        raw_index = json.dumps(index, separators=(",", ":")).encode()
+        pointer = TILED_POINTER.pack(dst.tell(), len(raw_index) + TAG_SIZE)
+        dst.write(aead.encrypt(INDEX_NONCE, raw_index, header + pointer))
+        dst.seek(HEADER.size)
+        dst.write(pointer)
+    report_chunk(src_size, progress, None)
+
+
+def read_tiled_index(src, key):
+    header = read_header(src, TILED_MAGIC)
+    pointer = src.read(TILED_POINTER.size)
+    if len(pointer) < TILED_POINTER.size:
+        raise ValueError("Encrypted file is truncated.")
+    aead = AEADS[header.suite](read_file_key(src, header, key))
+    offset, length = TILED_POINTER.unpack(pointer)
+    src.seek(offset)
+    sealed = src.read(length)
+    try:
+        index = json.loads(aead.decrypt(INDEX_NONCE, sealed, header.raw + pointer))
+    except InvalidTag:
+        raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+    return header, aead, index
+
+
+def tiled_levels(path, key):
+    # (width, height) of every zoom level, full resolution first.
+    with open(path, 'rb') as src:
+        _, _, index = read_tiled_index(src, key)
+    return [(layer["width"], layer["height"]) for layer in index["levels"]]
+
+
+def decrypt_region(path, key, box=None, level=0):
+    # box is (left, upper, right, lower) in full-resolution pixels, None for the
+    # whole image; level n returns the region at 1/2**n scale. Only the tiles
+    # that intersect the box are read and decrypted.
+    with open(path, 'rb') as src:
+        header, aead, index = read_tiled_index(src, key)
+        if not 0 <= level < len(index["levels"]):
+            raise ValueError(f"Zoom level must be between 0 and {len(index['levels']) - 1}.")
+        layer = index["levels"][level]
+        tile_size, scale = header.chunk_size, 2 ** level
+        if box is None:
+            box = (0, 0, index["levels"][0]["width"], index["levels"][0]["height"])
+        left, upper = max(0, box[0] // scale), max(0, box[1] // scale)
+        right, lower = min(layer["width"], -(-box[2] // scale)), min(layer["height"], -(-box[3] // scale))
+        if right <= left or lower <= upper:
+            raise ValueError("Region is empty or outside the image.")
+        first_tile = sum(len(finer["tiles"]) for finer in index["levels"][:level])
+        region = Image.new(index["mode"], (right - left, lower - upper))
+        for row in range(upper // tile_size, (lower - 1) // tile_size + 1):
+            for column in range(left // tile_size, (right - 1) // tile_size + 1):
+                offset, length = layer["tiles"][row * layer["columns"] + column]
+                src.seek(offset)
+                sealed = src.read(length)
+                number = first_tile + row * layer["columns"] + column
+                try:
+                    data = aead.decrypt(tile_nonce(number), sealed, header.raw + TILE_POSITION.pack(level, column, row))
+                except InvalidTag:
+                    raise ValueError("Authentication failed: wrong key or corrupted file.") from None
+                with Image.open(io.BytesIO(data)) as tile:
+                    region.paste(tile, (column * tile_size - left, row * tile_size - upper))
+    return region
+
+
+def rotate_file(path, old_key, new_key):
+    # Re-wraps the file key under new_key in place; the payload is untouched and
+    # the modification time is kept. Returns False if new_key is already in use.
+    # The wrapped key is a few dozen bytes inside one sector; it is synced before
+    # returning so an old-key file never looks rotated after a crash.
+    container = detect_container(path)
+    if container == "fernet":
+        raise ValueError("Legacy Fernet file: re-encrypt it to change its key.")
+    src_stat = os.stat(path)
+    with open(path, 'r+b') as f:
+        header = read_header(f, MAGIC if container == "binary" else TILED_MAGIC)
+        if not header.flags & FLAG_ENVELOPE:
+            raise ValueError("File predates envelope keys: re-encrypt it to change its key.")
+        if container == "tiled":
+            f.seek(TILED_POINTER.size, os.SEEK_CUR)
+        offset = f.tell()
+        wrapped = read_key_section(f, header)
+        try:
+            file_key = unwrap_file_key(old_key, header.salt, header.raw, wrapped)
+        except ValueError:
+            unwrap_file_key(new_key, header.salt, header.raw, wrapped)
+            return False
+        f.seek(offset)
+        f.write(wrap_file_key(new_key, header.salt, header.raw, file_key))
+        f.flush()
+        os.fsync(f.fileno())
+    os.utime(path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+
+def rotate_one(path, old_key, new_key):
+    # (path, rotate_file result, error); one bad file must not stop the run.
+    try:
+        return path, rotate_file(path, old_key, new_key), None
+    except Exception as e:
+        return path, None, e
+
+
+def run_rotation(root, old_key, new_key, workers=None):
+    # Only a few dozen bytes per file are read and written, so threads suffice.
+    # map_ordered keeps a bounded window of files in flight, however large the tree.
+    workers = workers or 4 * (os.cpu_count() or 1)
+    started = time.perf_counter()
+    rotated = current = failed = 0
+    jobs = ((path, old_key, new_key) for path, _ in iter_tree(root, root))
+    for path, result, error in map_ordered(rotate_one, jobs, workers):
+        if error is not None:
+            failed += 1
+            print(f"{path}: {error}", file=sys.stderr)
+        elif result:
+            rotated += 1
+        else:
+            current += 1
+    elapsed = time.perf_counter() - started
+    rate = rotated / elapsed if elapsed else 0.0
+    print(f"Rotated {rotated} files in {elapsed:.2f} s ({rate:.0f} files/s) with {workers} workers; "
+          f"{current} already on the new key, {failed} failed.")
+    return failed
+
+
+def read_key_file(key_path):
+    with open(key_path, 'rb') as f:
+        return f.read()
+
+
+def encrypted_size(plain_size, chunk_size=CHUNK_SIZE, container="binary"):
+    # None when the size depends on the image content (tiled).
+    if container == "tiled":
+        return None
+    if container == "fernet":
+        # version(1) timestamp(8) iv(16) padded ciphertext hmac(32), base64 encoded
+        token = 57 + (plain_size // 16 + 1) * 16
+        return -(-token // 3) * 4
+    chunks = max(1, -(-plain_size // chunk_size))
+    return HEADER.size + chunks * TAG_SIZE + plain_size
+
+
+def decrypted_size(src_path):
+    # None for legacy Fernet and compressed files, whose plaintext size is not
+    # known up front.
+    try:
+        header = read_container_header(src_path)
+        payload = os.path.getsize(src_path) - payload_offset(src_path)
+    except ValueError:
+        return None
+    if header.compression:
+        return None
+    blocks = max(1, -(-payload // (header.chunk_size + TAG_SIZE)))
+    return payload - blocks * TAG_SIZE
+
+
+def is_up_to_date(mode, src_path, dst_path, options):
+    # Batch outputs carry their source's mtime, so an unchanged source with a
+    # correctly sized output has nothing left to do.
+    try:
+        src_stat = os.stat(src_path)
+        dst_stat = os.stat(dst_path)
+    except FileNotFoundError:
+        return False
+    if dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+        return False
+    if mode == "encrypt":
+        container = options.get("container", "binary")
+        expected = encrypted_size(src_stat.st_size, container=container)
+        if expected is not None and container == "binary":
+            try:
+                if read_container_header(dst_path).compression:
+                    return True
+                expected += payload_offset(dst_path) - HEADER.size
+            except ValueError:
+                return False
+    else:
+        expected = decrypted_size(src_path)
+    return expected is None or dst_stat.st_size == expected
+
+
+# options are extra keyword arguments for encrypt_file (e.g. container).
+def process_file(mode, src_path, dst_path, key, options):
+    src_stat = os.stat(src_path)
+    os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+    if mode == "encrypt":
+        encrypt_file(src_path, dst_path, key, **options)
+    else:
+        decrypt_file(src_path, dst_path, key)
+    os.utime(dst_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return src_stat.st_size
+
+
+def iter_tree(src_root, dst_root):
+    for dirpath, _, filenames in os.walk(src_root):
+        for name in sorted(filenames):
+            src_path = os.path.join(dirpath, name)
+            yield src_path, os.path.join(dst_root, os.path.relpath(src_path, src_root))
+
+
+def check_separate_trees(src_root, dst_root):
+    # Writing into the tree being walked (or above it) would overwrite inputs
+    # or feed outputs back in as new inputs.
+    src, dst = os.path.realpath(src_root), os.path.realpath(dst_root)
+    if os.path.commonpath([src, dst]) in (src, dst):
+        raise ValueError(f"Output folder {dst_root} must not be, contain or be inside the input folder {src_root}.")
+
+
+def run_batch(mode, src_root, dst_root, key, workers=None, force=False, options=None):
+    check_separate_trees(src_root, dst_root)
+    options = options or {}
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    done = skipped = failed = total_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for src_path, dst_path in iter_tree(src_root, dst_root):
+            if not force and is_up_to_date(mode, src_path, dst_path, options):
+                skipped += 1
+                continue
+            futures[pool.submit(process_file, mode, src_path, dst_path, key, options)] = src_path
+        for future in as_completed(futures):
+            try:
+                total_bytes += future.result()
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"{futures[future]}: {e}", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    rate = total_bytes / (1024 * 1024) / elapsed if elapsed else 0.0
+    print(f"{mode.capitalize()}ed {done} files ({total_bytes / (1024 * 1024):.1f} MB) in {elapsed:.2f} s "
+          f"at {rate:.1f} MB/s with {workers} workers; {skipped} up to date, {failed} failed.")
+    return failed
+
+
+# Watch-folder mode. Producers such as cameras write files in place, so a file
+# is only picked up once its size and mtime have stayed the same for a while.
+WATCH_IGNORED_SUFFIXES = (".part", ".tmp", ".crdownload")
+
+
+def is_ignored_name(name):
+    return name.startswith(".") or name.lower().endswith(WATCH_IGNORED_SUFFIXES)
+
+
+def watch_file(src_path, dst_path, key, options, done_path):
+    # Encrypt to a temporary name first so readers of the output folder never
+    # see a half-written file, then remove (or move away) the plaintext.
+    tmp_path = dst_path + ".part"
+    try:
+        size = process_file("encrypt", src_path, tmp_path, key, options)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        remove_partial(tmp_path)
+        raise
+    if done_path:
+        os.makedirs(os.path.dirname(done_path) or ".", exist_ok=True)
+        os.replace(src_path, done_path)
+    else:
+        os.remove(src_path)
+    return size
+
+
+def write_status(path, status):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_watch(src_root, dst_root, key, workers=None, options=None, interval=2.0, settle=2.0,
+              batch_size=64, max_pending=None, done_root=None, status_path=None, once=False,
+              delete_originals=False):
+    if not done_root and not delete_originals:
+        raise ValueError("Pass a folder for the originals or explicitly allow deleting them.")
+    check_separate_trees(src_root, dst_root)
+    if done_root:
+        check_separate_trees(src_root, done_root)
+    options = options or {}
+    workers = workers or os.cpu_count() or 1
+    # Backpressure: never have more than this many files queued or running, so
+    # a burst of new files waits on disk instead of piling up in memory.
+    max_pending = max_pending or workers * 4
+    stat_cache = {}
+    # Files that failed, by the (size, mtime) they had; left alone until they change.
+    failed = {}
+    futures = {}
+    stats = {"encrypted": 0, "failed": 0, "bytes": 0, "last_error": None}
+    started = time.time()
+    print(f"Watching {src_root} (Ctrl+C to stop)")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                for future in [f for f in futures if f.done()]:
+                    src_path = futures.pop(future)
+                    signature, _ = stat_cache.pop(src_path)
+                    try:
+                        stats["bytes"] += future.result()
+                        stats["encrypted"] += 1
+                    except Exception as e:
+                        failed[src_path] = signature
+                        stats["failed"] += 1
+                        stats["last_error"] = f"{src_path}: {e}"
+                        print(stats["last_error"], file=sys.stderr)
+
+                # Scan with a stat cache: a file is ready once two polls at
+                # least `settle` seconds apart saw the same size and mtime.
+                now = time.monotonic()
+                ready = []
+                seen = set()
+                for dirpath, dirnames, filenames in os.walk(src_root):
+                    dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                    for name in filenames:
+                        src_path = os.path.join(dirpath, name)
+                        if is_ignored_name(name) or src_path in futures.values():
+                            continue
+                        try:
+                            src_stat = os.stat(src_path)
+                        except OSError:
+                            continue
+                        seen.add(src_path)
+                        signature = (src_stat.st_size, src_stat.st_mtime_ns)
+                        if failed.get(src_path) == signature:
+                            continue
+                        failed.pop(src_path, None)
+                        cached = stat_cache.get(src_path)
+                        if cached is None or cached[0] != signature:
+                            stat_cache[src_path] = (signature, now)
+                        elif now - cached[1] >= settle:
+                            ready.append(src_path)
+                for src_path in list(stat_cache):
+                    if src_path not in seen and src_path not in futures.values():
+                        del stat_cache[src_path]
+                for src_path in list(failed):
+                    if src_path not in seen:
+                        del failed[src_path]
+
+                room = min(batch_size, max_pending - len(futures))
+                for src_path in sorted(ready)[:max(room, 0)]:
+                    rel_path = os.path.relpath(src_path, src_root)
+                    dst_path = os.path.join(dst_root, rel_path)
+                    done_path = os.path.join(done_root, rel_path) if done_root else None
+                    futures[pool.submit(watch_file, src_path, dst_path, key, options, done_path)] = src_path
+
+                if status_path:
+                    uptime = time.time() - started
+                    write_status(status_path, dict(
+                        stats, updated=time.time(), uptime=round(uptime, 1), in_flight=len(futures),
+                        waiting=max(len(ready) - max(room, 0), 0), tracked=len(stat_cache), skipped=len(failed),
+                        mb_per_s=round(stats["bytes"] / (1024 * 1024) / uptime, 2) if uptime else 0.0))
+                if once and not futures and not stat_cache:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopping; finishing files already started...")
+            for future in futures:
+                future.cancel()
+    print(f"Encrypted {stats['encrypted']} files ({stats['bytes'] / (1024 * 1024):.1f} MB); "
+          f"{stats['failed']} failed.")
+    return stats["failed"]
+
+
+# Deduplicating store layout:
+#   config.json   store format version and the (public) key-derivation salt
+#   manifest.bin  nonce(12) + sealed JSON: for every stored path its size,
+#                 mtime and ordered chunk ids
+#   objects/xx/   one sealed object per distinct chunk: nonce(12) + ciphertext
+# Files are cut into content-defined chunks, so an edit only changes the
+# chunks around it. A chunk's id is a keyed HMAC of its plaintext: identical
+# chunks (and files) are stored once, and ids reveal nothing without the key.
+STORE_VERSION = 1
+STORE_MIN_CHUNK = 64 * 1024
+STORE_MAX_CHUNK = 1024 * 1024
+# Each set holds the byte values allowed at one position of a cut point; the
+# odds of a match are 16*16*16*4 / 256**4 = 1/2**18, so chunks average 256 KiB.
+STORE_CUT_SET_SIZES = (16, 16, 16, 4)
+
+
+class ImageStore:
+    def __init__(self, root, key):
+        self.root = root
+        config_path = os.path.join(root, "config.json")
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                config = json.load(f)
+            if config.get("version") != STORE_VERSION:
+                raise ValueError(f"Unsupported store version {config.get('version')}.")
+        else:
+            os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+            config = {"version": STORE_VERSION, "salt": os.urandom(16).hex()}
+            self.write_atomic(config_path, json.dumps(config).encode())
+        salt = bytes.fromhex(config["salt"])
+        self.id_key = derive_file_key(key, salt, b"image-crypto store id")
+        self.aead = AESGCM(derive_file_key(key, salt, b"image-crypto store data"))
+        self.cut_pattern = self.make_cut_pattern()
+        self.manifest = self.load_manifest()
+
+    def make_cut_pattern(self):
+        # Keyed cut points: the byte sets come from the id key, so chunk
+        # boundaries cannot be predicted without it. re scans at C speed.
+        seed = hmac.new(self.id_key, b"cut points", hashlib.sha256).digest()
+        rng = random.Random(seed)
+        classes = []
+        for size in STORE_CUT_SET_SIZES:
+            values = sorted(rng.sample(range(256), size))
+            classes.append(b"[" + b"".join(re.escape(bytes([v])) for v in values) + b"]")
+        return re.compile(b"".join(classes))
+
+    def write_atomic(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load_manifest(self):
+        path = os.path.join(self.root, "manifest.bin")
+        if not os.path.exists(path):
+            return {"files": {}}
+        with open(path, 'rb') as f:
+            sealed = f.read()
+        try:
+            return json.loads(self.aead.decrypt(sealed[:12], sealed[12:], b"manifest"))
+        except InvalidTag:
+            raise ValueError("Authentication failed: wrong key or corrupted manifest.") from None
+
+    def save_manifest(self):
+        nonce = os.urandom(12)
+        data = json.dumps(self.manifest, separators=(",", ":")).encode()
+        self.write_atomic(os.path.join(self.root, "manifest.bin"), nonce + self.aead.encrypt(nonce, data, b"manifest"))
+
+    def object_path(self, chunk_id):
+        return os.path.join(self.root, "objects", chunk_id[:2], chunk_id)
+
+    def iter_chunks(self, src):
+        buffer = b""
+        eof = False
+        while True:
+            while not eof and len(buffer) < STORE_MAX_CHUNK:
+                data = src.read(STORE_MAX_CHUNK)
+                eof = not data
+                buffer += data
+            if not buffer:
+                return
+            match = self.cut_pattern.search(buffer, STORE_MIN_CHUNK, STORE_MAX_CHUNK)
+            cut = match.end() if match else min(len(buffer), STORE_MAX_CHUNK)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+    def put_chunk(self, chunk):
+        # Returns (chunk id, bytes written); nothing is written for known chunks.
+        chunk_id = hmac.new(self.id_key, chunk, hashlib.sha256).hexdigest()
+        path = self.object_path(chunk_id)
+        if os.path.exists(path):
+            return chunk_id, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        nonce = os.urandom(12)
+        sealed = nonce + self.aead.encrypt(nonce, chunk, chunk_id.encode())
+        self.write_atomic(path, sealed)
+        return chunk_id, len(sealed)
+
+    def add_file(self, path):
+        chunk_ids = []
+        written = 0
+        with open(path, 'rb') as src:
+            for chunk in self.iter_chunks(src):
+                chunk_id, size = self.put_chunk(chunk)
+                chunk_ids.append(chunk_id)
+                written += size
+        return chunk_ids, written
+
+    def add_tree(self, src_root, workers=None, prune=False):
+        # Unchanged files (same size and mtime as in the manifest) are not read;
+        # changed and new files only cost the chunks that are not stored yet.
+        # With prune, chunks only deleted or changed files used are removed.
+        workers = workers or os.cpu_count() or 1
+        started = time.perf_counter()
+        files = self.manifest["files"]
+        seen = set()
+        todo = []
+        for path, _ in iter_tree(src_root, src_root):
+            name = os.path.relpath(path, src_root).replace(os.sep, "/")
+            seen.add(name)
+            src_stat = os.stat(path)
+            entry = files.get(name)
+            if entry and entry["size"] == src_stat.st_size and entry["mtime_ns"] == src_stat.st_mtime_ns:
+                continue
+            todo.append((name, path, src_stat))
+        added = read_bytes = written = failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.add_file, path): (name, path, src_stat) for name, path, src_stat in todo}
+            for future in as_completed(futures):
+                name, path, src_stat = futures[future]
+                try:
+                    chunk_ids, size = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"{path}: {e}", file=sys.stderr)
+                    continue
+                files[name] = {"size": src_stat.st_size, "mtime_ns": src_stat.st_mtime_ns, "chunks": chunk_ids}
+                added += 1
+                read_bytes += src_stat.st_size
+                written += size
+        removed = [name for name in files if name not in seen]
+        for name in removed:
+            del files[name]
+        self.save_manifest()
+        elapsed = time.perf_counter() - started
+        print(f"Stored {added} new or changed files ({read_bytes / (1024 * 1024):.1f} MB read, "
+              f"{written / (1024 * 1024):.1f} MB written after deduplication) in {elapsed:.2f} s; "
+              f"{len(seen) - len(todo)} unchanged, {len(removed)} removed, {failed} failed.")
+        if prune:
+            self.prune()
+        return failed
+
+    def prune(self):
+        # Deletes objects no manifest entry refers to. Must not run while another
+        # process adds to the same store: its new chunks are not listed yet.
+        referenced = {chunk_id for entry in self.manifest["files"].values() for chunk_id in entry["chunks"]}
+        deleted = freed = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, "objects")):
+            for name in filenames:
+                if name in referenced or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                deleted += 1
+        print(f"Pruned {deleted} unused chunks ({freed / (1024 * 1024):.1f} MB freed).")
+        return deleted
+
+    def restore_file(self, name, dst_path):
+        entry = self.manifest["files"][name]
+        os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+        try:
+            with open(dst_path, 'wb') as dst:
+                for chunk_id in entry["chunks"]:
+                    with open(self.object_path(chunk_id), 'rb') as f:
+                        sealed = f.read()
+                    try:
+                        dst.write(self.aead.decrypt(sealed[:12], sealed[12:], chunk_id.encode()))
+                    except InvalidTag:
+                        raise ValueError(f"Object {chunk_id} failed authentication.") from None
+        except BaseException:
+            remove_partial(dst_path)
+            raise
+        os.utime(dst_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    def restore_tree(self, dst_root):
+        failed = 0
+        for name in sorted(self.manifest["files"]):
+            try:
+                self.restore_file(name, os.path.join(dst_root, *name.split("/")))
+            except Exception as e:
+                failed += 1
+                print(f"{name}: {e}", file=sys.stderr)
+        print(f"Restored {len(self.manifest['files']) - failed} files; {failed} failed.")
+        return failed
+
 
 class ImageCryptoGUI:
     def __init__(self, root):
@@ -12,6 +1263,14 @@ class ImageCryptoGUI:
         self.file_path = tk.StringVar()
         self.save_path = tk.StringVar()
         self.image_label = None  # For displaying image
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.events = queue.Queue()
+        self.use_all_cores = tk.BooleanVar(value=False)
+        self.container = tk.StringVar(value="binary")
+        self.suite = tk.StringVar(value="aes-256-gcm")
+        self.embed_thumbnail = tk.BooleanVar(value=True)
+        self.compression = tk.StringVar(value="none")
 
         tk.Label(root, text="Input File:").grid(row=0, column=0, padx=5, pady=5)
         tk.Entry(root, textvariable=self.file_path, width=40).grid(row=0, column=1, padx=5, pady=5)
@@ -22,8 +1281,10 @@ class ImageCryptoGUI:
         tk.Button(root, text="Browse", command=self.save_file).grid(row=1, column=2, padx=5, pady=5)
 
         tk.Button(root, text="Generate Key", command=self.generate_key).grid(row=2, column=0, padx=5, pady=10)
-        tk.Button(root, text="Encrypt", command=self.encrypt_image).grid(row=2, column=1, padx=5, pady=10)
-        tk.Button(root, text="Decrypt", command=self.decrypt_image).grid(row=2, column=2, padx=5, pady=10)
+        self.encrypt_button = tk.Button(root, text="Encrypt", command=self.encrypt_image)
+        self.encrypt_button.grid(row=2, column=1, padx=5, pady=10)
+        self.decrypt_button = tk.Button(root, text="Decrypt", command=self.decrypt_image)
+        self.decrypt_button.grid(row=2, column=2, padx=5, pady=10)
 
         tk.Label(root, text="Key file:").grid(row=3, column=0, padx=5, pady=5)
         self.key_path_entry = tk.Entry(root, width=40)
@@ -31,6 +1292,25 @@ class ImageCryptoGUI:
         self.key_path_entry.grid(row=3, column=1, padx=5, pady=5)
         tk.Button(root, text="Browse", command=self.browse_key).grid(row=3, column=2, padx=5, pady=5)
 
+        self.progress = ttk.Progressbar(root, mode="determinate", length=300)
+        self.progress.grid(row=4, column=0, columnspan=2, padx=5, pady=10, sticky="we")
+        self.cancel_button = tk.Button(root, text="Cancel", command=self.cancel_job, state=tk.DISABLED)
+        self.cancel_button.grid(row=4, column=2, padx=5, pady=10)
+        tk.Checkbutton(root, text="Use all CPU cores for large files", variable=self.use_all_cores).grid(
+            row=5, column=0, columnspan=3, padx=5, pady=5, sticky="w")
+        tk.Label(root, text="Format:").grid(row=6, column=0, padx=5, pady=5)
+        ttk.Combobox(root, textvariable=self.container, values=CONTAINERS, state="readonly", width=10).grid(
+            row=6, column=1, padx=5, pady=5, sticky="w")
+        tk.Label(root, text="Cipher:").grid(row=7, column=0, padx=5, pady=5)
+        ttk.Combobox(root, textvariable=self.suite, values=list(SUITES), state="readonly", width=20).grid(
+            row=7, column=1, padx=5, pady=5, sticky="w")
+        tk.Checkbutton(root, text="Embed encrypted preview thumbnail", variable=self.embed_thumbnail).grid(
+            row=8, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        tk.Button(root, text="Preview", command=self.preview_image).grid(row=8, column=2, padx=5, pady=5)
+        tk.Label(root, text="Compression:").grid(row=9, column=0, padx=5, pady=5)
+        ttk.Combobox(root, textvariable=self.compression, values=list(COMPRESSIONS), state="readonly", width=10).grid(
+            row=9, column=1, padx=5, pady=5, sticky="w")
+
     def browse_file(self):
         path = filedialog.askopenfilename(title="Select file")
         if path:
@@ -59,61 +1339,318 @@ class ImageCryptoGUI:
         if not os.path.exists(key_path):
             messagebox.showerror("Error", f"Key file not found: {key_path}")
             return None
-        with open(key_path, 'rb') as f:
-            return f.read()
+        return read_key_file(key_path)
 
     def encrypt_image(self):
+        self.start_job("encrypt")
+
+    def decrypt_image(self):
+        self.start_job("decrypt")
+
+    def start_job(self, mode):
+        if self.worker is not None:
+            return
         key = self.load_key()
         if not key:
             return
-        if not self.file_path.get() or not self.save_path.get():
+        src_path, dst_path = self.file_path.get(), self.save_path.get()
+        if not src_path or (not dst_path and mode != "preview"):
             messagebox.showerror("Error", "Specify input and output files.")
             return
-        fernet = Fernet(key)
         try:
-            with open(self.file_path.get(), 'rb') as file:
-                original = file.read()
-            encrypted = fernet.encrypt(original)
-            with open(self.save_path.get(), 'wb') as enc_file:
-                enc_file.write(encrypted)
-            messagebox.showinfo("Success", f"Image encrypted and saved to {self.save_path.get()}")
+            total = os.path.getsize(src_path)
+        except OSError as e:
+            messagebox.showerror("Error", f"Cannot read input file: {e}")
+            return
+        self.progress.configure(maximum=max(total, 1), value=0)
+        self.cancel_event.clear()
+        self.set_busy(True)
+        workers = (os.cpu_count() or 1) if self.use_all_cores.get() else 1
+        options = {"container": self.container.get(), "suite": self.suite.get(),
+                   "thumbnail": self.embed_thumbnail.get(), "compression": self.compression.get()}
+        self.worker = threading.Thread(target=self.run_job, args=(mode, src_path, dst_path, key, workers, options),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(50, self.poll_job)
+
+    def run_job(self, mode, src_path, dst_path, key, workers, options):
+        # Runs on the worker thread; the Tk widgets are only touched from poll_job.
+        report = lambda done: self.events.put(("progress", done))
+        try:
+            if mode == "encrypt":
+                encrypt_file(src_path, dst_path, key, progress=report, cancel=self.cancel_event, workers=workers,
+                             **options)
+            elif mode == "decrypt":
+                decrypt_file(src_path, dst_path, key, progress=report, cancel=self.cancel_event, workers=workers)
+            else:
+                # Preview: decrypt into memory and decode at reduced resolution here,
+                # so neither plaintext on disk nor a full-size decode is needed.
+                data = decrypt_to_memory(src_path, key, progress=report, cancel=self.cancel_event, workers=workers)
+                self.events.put(("done", (mode, open_preview(io.BytesIO(data)))))
+                return
+            self.events.put(("done", (mode, dst_path)))
+        except OperationCancelled:
+            self.events.put(("cancelled", mode))
         except Exception as e:
-            messagebox.showerror("Error", f"Encryption failed: {e}")
+            self.events.put(("error", (mode, e)))
 
-    def decrypt_image(self):
+    def poll_job(self):
+        finished = None
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.progress.configure(value=value)
+            else:
+                finished = (kind, value)
+        if finished is None:
+            self.root.after(50, self.poll_job)
+            return
+        self.worker = None
+        self.set_busy(False)
+        kind, value = finished
+        if kind == "done":
+            mode, result = value
+            if mode == "encrypt":
+                messagebox.showinfo("Success", f"Image encrypted and saved to {result}")
+            elif mode == "decrypt":
+                messagebox.showinfo("Success", f"Image decrypted and saved to {result}")
+                self.show_image(result)
+            else:
+                self.display_image(result, "Decrypted Image Preview")
+        elif kind == "cancelled":
+            self.progress.configure(value=0)
+            if value == "preview":
+                messagebox.showinfo("Cancelled", "Preview cancelled.")
+            else:
+                messagebox.showinfo("Cancelled", f"{value.capitalize()}ion cancelled; partial output removed.")
+        else:
+            mode, e = value
+            if mode == "preview":
+                messagebox.showerror("Error", f"Preview failed: {e}")
+            else:
+                messagebox.showerror("Error", f"{mode.capitalize()}ion failed: {e}")
+
+    def cancel_job(self):
+        self.cancel_event.set()
+
+    def set_busy(self, busy):
+        self.encrypt_button.configure(state=tk.DISABLED if busy else tk.NORMAL)
+        self.decrypt_button.configure(state=tk.DISABLED if busy else tk.NORMAL)
+        self.cancel_button.configure(state=tk.NORMAL if busy else tk.DISABLED)
+
+    def preview_image(self):
+        # Shows the embedded thumbnail of an encrypted file without decrypting the payload.
         key = self.load_key()
         if not key:
             return
-        if not self.file_path.get() or not self.save_path.get():
-            messagebox.showerror("Error", "Specify input and output files.")
+        if not self.file_path.get():
+            messagebox.showerror("Error", "Specify an input file.")
             return
-        fernet = Fernet(key)
         try:
-            with open(self.file_path.get(), 'rb') as enc_file:
-                encrypted = enc_file.read()
-            decrypted = fernet.decrypt(encrypted)
-            with open(self.save_path.get(), 'wb') as dec_file:
-                dec_file.write(decrypted)
-            messagebox.showinfo("Success", f"Image decrypted and saved to {self.save_path.get()}")
-            self.show_image(self.save_path.get())
+            thumbnail = None
+            container = detect_container(self.file_path.get())
+            if container == "tiled":
+                # The coarsest zoom level that still fills the preview window.
+                levels = tiled_levels(self.file_path.get(), key)
+                level = max(n for n, size in enumerate(levels) if n == 0 or min(size) >= min(PREVIEW_SIZE))
+                img = decrypt_region(self.file_path.get(), key, level=level)
+                img.thumbnail(PREVIEW_SIZE)
+                self.display_image(img, "Encrypted Image Preview")
+                return
+            if container == "binary":
+                thumbnail = load_thumbnail(self.file_path.get(), key)
         except Exception as e:
-            messagebox.showerror("Error", f"Decryption failed: {e}")
+            messagebox.showerror("Error", f"Could not read preview: {e}")
+            return
+        if thumbnail is None:
+            # No embedded thumbnail: decrypt the whole image in memory instead.
+            self.start_job("preview")
+            return
+        try:
+            self.display_image(open_preview(io.BytesIO(thumbnail)), "Encrypted Image Preview")
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not open image: {e}")
 
     def show_image(self, path):
-        top = tk.Toplevel(self.root)
-        top.title("Decrypted Image Preview")
         try:
-            img = Image.open(path)
-            img.thumbnail((500, 500))  # Resize for preview
-            photo = ImageTk.PhotoImage(img)
-            label = tk.Label(top, image=photo)
-            label.image = photo  # Keep reference
-            label.pack()
+            img = open_preview(path)
         except Exception as e:
             messagebox.showerror("Error", f"Could not open image: {e}")
+            return
+        self.display_image(img, "Decrypted Image Preview")
+
+    def display_image(self, img, title):
+        top = tk.Toplevel(self.root)
+        top.title(title)
+        photo = ImageTk.PhotoImage(img)
+        label = tk.Label(top, image=photo)
+        label.image = photo  # Keep reference
+        label.pack()
+
+
+def run_pipe(args, key):
+    if args.command == "encrypt" and (args.container != "binary" or args.thumbnail):
+        raise ValueError("Streaming through stdin/stdout supports only the binary format without thumbnail.")
+    src = sys.stdin.buffer if args.src == "-" else open(args.src, 'rb')
+    dst = sys.stdout.buffer if args.dst == "-" else open(args.dst, 'wb')
+    try:
+        if args.command == "encrypt":
+            encrypt_pipe(src, dst, key, args.workers, args.pool, args.suite, args.compress, args.level)
+        else:
+            decrypt_pipe(src, dst, key, args.workers, args.pool)
+        dst.flush()
+    except BaseException:
+        if args.dst != "-":
+            dst.close()
+            remove_partial(args.dst)
+        raise
+    finally:
+        for f, path in ((src, args.src), (dst, args.dst)):
+            if path != "-":
+                f.close()
+    return 0
+
+
+def run_command(args):
+    if args.command == "batch":
+        key = read_key_file(args.key)
+        options = {}
+        if args.mode == "encrypt":
+            options = {"container": args.container, "suite": args.suite, "thumbnail": args.thumbnail,
+                       "compression": args.compress, "level": args.level}
+        return 1 if run_batch(args.mode, args.src, args.dst, key, args.workers, args.force, options) else 0
+    if args.command == "watch":
+        options = {"container": args.container, "suite": args.suite, "thumbnail": args.thumbnail,
+                   "compression": args.compress, "level": args.level}
+        return 1 if run_watch(args.src, args.dst, read_key_file(args.key), args.workers, options, args.interval,
+                              args.settle, args.batch, args.max_pending, args.done, args.status, args.once,
+                              args.delete_originals) else 0
+    if args.command == "store":
+        image_store = ImageStore(args.store, read_key_file(args.key))
+        if args.action == "add":
+            return 1 if image_store.add_tree(args.path, args.workers, args.prune) else 0
+        return 1 if image_store.restore_tree(args.path) else 0
+    if args.command == "keygen":
+        with open(args.path, 'xb') as f:
+            f.write(Fernet.generate_key())
+        return 0
+    if args.command == "rotate":
+        old_key, new_key = read_key_file(args.old_key), read_key_file(args.new_key)
+        return 1 if run_rotation(args.root, old_key, new_key, args.workers) else 0
+    if args.command == "region":
+        decrypt_region(args.src, read_key_file(args.key), args.box, args.level).save(args.dst)
+        return 0
+    if args.command in ("encrypt", "decrypt"):
+        key = read_key_file(args.key)
+        if "-" in (args.src, args.dst):
+            return run_pipe(args, key)
+        if args.command == "encrypt":
+            encrypt_file(args.src, args.dst, key, workers=args.workers, pool=args.pool, container=args.container,
+                         suite=args.suite, thumbnail=args.thumbnail, compression=args.compress, level=args.level)
+        else:
+            decrypt_file(args.src, args.dst, key, workers=args.workers, pool=args.pool)
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Image encryption/decryption. Starts the GUI when run without a command.")
+    commands = parser.add_subparsers(dest="command")
+    batch = commands.add_parser("batch", help="encrypt or decrypt a directory tree without the GUI")
+    batch.add_argument("mode", choices=["encrypt", "decrypt"])
+    batch.add_argument("src", help="input directory")
+    batch.add_argument("dst", help="output directory (mirrors the input layout)")
+    batch.add_argument("--key", default="key.key", help="key file (default: key.key)")
+    batch.add_argument("--workers", type=int, help="worker processes (default: number of cores)")
+    batch.add_argument("--force", action="store_true", help="process files even if the output is up to date")
+    batch.add_argument("--format", dest="container", choices=CONTAINERS, default="binary",
+                       help="container written when encrypting (default: binary)")
+    batch.add_argument("--suite", choices=list(SUITES), default="aes-256-gcm",
+                       help="cipher for the binary container (default: aes-256-gcm)")
+    batch.add_argument("--thumbnail", action="store_true", help="embed an encrypted preview thumbnail")
+    batch.add_argument("--compress", choices=list(COMPRESSIONS), default="none",
+                       help="compress before encrypting; skipped for data that does not shrink (default: none)")
+    batch.add_argument("--level", type=int, help="zlib level (1-9) or lzma preset (0-9)")
+    for mode in ("encrypt", "decrypt"):
+        single = commands.add_parser(mode, help=f"{mode} a single file without the GUI")
+        single.add_argument("src", help="input file, or - for stdin")
+        single.add_argument("dst", help="output file, or - for stdout")
+        single.add_argument("--key", default="key.key", help="key file (default: key.key)")
+        single.add_argument("--workers", type=int, default=1, help="chunks processed in parallel (default: 1)")
+        single.add_argument("--pool", choices=["thread", "process"], default="thread",
+                            help="pool used when --workers is above 1 (default: thread)")
+        if mode == "encrypt":
+            single.add_argument("--format", dest="container", choices=CONTAINERS, default="binary",
+                                help="container to write (default: binary)")
+            single.add_argument("--suite", choices=list(SUITES), default="aes-256-gcm",
+                                help="cipher for the binary container (default: aes-256-gcm)")
+            single.add_argument("--thumbnail", action="store_true", help="embed an encrypted preview thumbnail")
+            single.add_argument("--compress", choices=list(COMPRESSIONS), default="none",
+                                help="compress before encrypting; skipped for data that does not shrink (default: none)")
+            single.add_argument("--level", type=int, help="zlib level (1-9) or lzma preset (0-9)")
+    region = commands.add_parser("region", help="decrypt part of a tiled file into an image")
+    region.add_argument("src", help="tiled encrypted file")
+    region.add_argument("dst", help="output image (format from the extension)")
+    region.add_argument("--key", default="key.key", help="key file (default: key.key)")
+    region.add_argument("--box", type=int, nargs=4, metavar=("LEFT", "UPPER", "RIGHT", "LOWER"),
+                        help="region in full-resolution pixels (default: whole image)")
+    region.add_argument("--level", type=int, default=0, help="zoom level, n is 1/2**n scale (default: 0)")
+    watch = commands.add_parser("watch", help="keep encrypting images as they appear in a folder")
+    watch.add_argument("src", help="folder to watch")
+    watch.add_argument("dst", help="folder for encrypted files")
+    watch.add_argument("--key", default="key.key", help="key file (default: key.key)")
+    watch.add_argument("--workers", type=int, help="worker processes (default: number of cores)")
+    watch.add_argument("--interval", type=float, default=2.0, help="seconds between folder scans (default: 2)")
+    watch.add_argument("--settle", type=float, default=2.0,
+                       help="seconds a file must stay unchanged before it is picked up (default: 2)")
+    watch.add_argument("--batch", type=int, default=64, help="most files started per scan (default: 64)")
+    watch.add_argument("--max-pending", type=int, help="most files queued or running (default: 4 per worker)")
+    originals = watch.add_mutually_exclusive_group(required=True)
+    originals.add_argument("--done", help="move originals here once encrypted")
+    originals.add_argument("--delete-originals", action="store_true", help="delete originals once encrypted")
+    watch.add_argument("--status", help="JSON file updated after every scan with counters and throughput")
+    watch.add_argument("--once", action="store_true",
+                       help="exit once every file has been encrypted or has failed")
+    watch.add_argument("--format", dest="container", choices=CONTAINERS, default="binary",
+                       help="container format (default: binary)")
+    watch.add_argument("--suite", choices=list(SUITES), default="aes-256-gcm",
+                       help="cipher for the binary container (default: aes-256-gcm)")
+    watch.add_argument("--thumbnail", action="store_true", help="embed an encrypted preview thumbnail")
+    watch.add_argument("--compress", choices=list(COMPRESSIONS), default="none",
+                       help="compress before encrypting; skipped for data that does not shrink (default: none)")
+    watch.add_argument("--level", type=int, help="zlib level (1-9) or lzma preset (0-9)")
+    store = commands.add_parser("store", help="deduplicating encrypted store with incremental updates")
+    store.add_argument("action", choices=["add", "restore"])
+    store.add_argument("store", help="store directory")
+    store.add_argument("path", help="directory to add, or to restore into")
+    store.add_argument("--key", default="key.key", help="key file (default: key.key)")
+    store.add_argument("--workers", type=int, help="worker threads when adding (default: number of cores)")
+    store.add_argument("--prune", action="store_true",
+                       help="after adding, delete chunks no stored file uses any more")
+    keygen = commands.add_parser("keygen", help="write a new key file")
+    keygen.add_argument("path", help="key file to create")
+    rotate = commands.add_parser("rotate", help="re-wrap every file key in a directory tree under a new key file")
+    rotate.add_argument("root", help="directory of encrypted files")
+    rotate.add_argument("--old-key", required=True, help="key file the files are encrypted with")
+    rotate.add_argument("--new-key", required=True, help="key file to switch to")
+    rotate.add_argument("--workers", type=int, help="worker threads (default: 4 per core)")
+    args = parser.parse_args(argv)
+
+    if args.command:
+        try:
+            return run_command(args)
+        except (ValueError, OSError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
 
-if __name__ == "__main__":
     # Make sure Pillow is installed: pip install pillow
     root = tk.Tk()
     app = ImageCryptoGUI(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
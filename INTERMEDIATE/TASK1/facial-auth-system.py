@@ -1,19 +1,488 @@
 import cv2
 import numpy as np
 import os
+import sys
+import argparse
 import base64
-from flask import Flask, render_template_string, Response, request, session
+import collections
+import concurrent.futures
+import json
+import math
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from flask import Flask, render_template_string, Response, request, session, jsonify
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 app = Flask(__name__)
 app.secret_key = "super_secret_key_for_sessions"
 FACE_DIR = "registered_faces"
+# Frames can be captured in the browser and uploaded with the request, so the
+# server needs no webcam and any number of workers can serve logins.
+MAX_UPLOAD_FRAMES = 5
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024
+AUTH_THRESHOLD = 70
 os.makedirs(FACE_DIR, exist_ok=True)
 
 face_cascade = cv2.CascadeClassifier(
     cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
 )
-recognizer = cv2.face.LBPHFaceRecognizer_create()
+
+# Face features are the histograms OpenCV's LBPH recognizer uses (radius 1,
+# 8 neighbours, 8x8 grid), so distances match its confidence values.
+LBP_GRID = 8
+FEATURE_SIZE = LBP_GRID * LBP_GRID * 256
+TOP_K = 5
+RERANK = 50
+
+def lbph_histogram(face_img):
+    src = face_img.astype(np.float32)
+    rows, cols = src.shape
+    center = src[1:rows-1, 1:cols-1]
+    codes = np.zeros(center.shape, np.int32)
+    for n in range(8):
+        # Same sampling points and bilinear weights as OpenCV's elbp().
+        x = np.float32(math.cos(2.0 * math.pi * n / 8))
+        y = np.float32(-math.sin(2.0 * math.pi * n / 8))
+        fx, fy, cx, cy = math.floor(x), math.floor(y), math.ceil(x), math.ceil(y)
+        tx, ty = np.float32(x - fx), np.float32(y - fy)
+        shifted = lambda dy, dx: src[1+dy:rows-1+dy, 1+dx:cols-1+dx]
+        t = ((1 - tx) * (1 - ty) * shifted(fy, fx) + tx * (1 - ty) * shifted(fy, cx)
+             + (1 - tx) * ty * shifted(cy, fx) + tx * ty * shifted(cy, cx))
+        bit = (t > center) | (np.abs(t - center) < np.finfo(np.float32).eps)
+        codes |= bit.astype(np.int32) << n
+    h, w = codes.shape[0] // LBP_GRID, codes.shape[1] // LBP_GRID
+    cells = codes[:LBP_GRID*h, :LBP_GRID*w].reshape(LBP_GRID, h, LBP_GRID, w).transpose(0, 2, 1, 3)
+    cells = cells.reshape(LBP_GRID * LBP_GRID, h * w) + np.arange(LBP_GRID * LBP_GRID)[:, None] * 256
+    return np.bincount(cells.ravel(), minlength=FEATURE_SIZE).astype(np.float32) / (h * w)
+
+# All registered users live in one file: a 16-byte header (magic, version,
+# record size) followed by fixed-size records, so the whole gallery is mapped
+# into memory in one call instead of reading one PNG per user.
+GALLERY_PATH = os.path.join(FACE_DIR, "gallery.bin")
+# Several server processes can share one gallery: every write bumps the version
+# in this small manifest, and each process reloads when it sees it change.
+MANIFEST_PATH = os.path.join(FACE_DIR, "gallery.json")
+LOCK_PATH = os.path.join(FACE_DIR, "gallery.lock")
+GALLERY_MAGIC = b"FGAL"
+GALLERY_VERSION = 1
+GALLERY_HEADER_SIZE = 16
+FACE_SIZE = 200
+MAX_NAME_BYTES = 64
+# The feature comes first so every row starts 4-byte aligned and the feature
+# column can be handed to BLAS directly from the mapping.
+GALLERY_RECORD = np.dtype([
+    ("feature", np.float32, FEATURE_SIZE),
+    ("face", np.uint8, (FACE_SIZE, FACE_SIZE)),
+    ("name", f"S{MAX_NAME_BYTES}"),
+    ("registered", "<f8"),
+])
+
+@contextmanager
+def file_lock(path):
+    # Serializes gallery writes between processes. Without fcntl (Windows) only
+    # the per-process lock applies, which covers the single-process server.
+    with open(path, "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class FaceGallery:
+    # One record per user: the square root of the user's histogram, the face
+    # image, the username and the registration time. A login is one matrix-
+    # vector product over the feature column (a dot product of square roots
+    # ranks like chi-square), after which the best RERANK rows are scored with
+    # the exact chi-square distance LBPH uses. New users are appended;
+    # re-registering overwrites the user's record in place. The usernames are
+    # kept in memory, so listing or counting users never touches the disk.
+    def __init__(self, path, manifest_path, lock_path):
+        self.path = path
+        self.manifest_path = manifest_path
+        self.lock_path = lock_path
+        self.lock = threading.Lock()
+        self.records = np.zeros(0, GALLERY_RECORD)
+        self.names = []
+        self.rows = {}
+        self.version = 0
+        self.manifest_stat = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self):
+        # Runs at import, so every process a WSGI server starts opens (or, the
+        # first time, creates) the gallery before serving requests.
+        with self.lock:
+            with file_lock(self.lock_path):
+                if not os.path.exists(self.path):
+                    with open(self.path, 'wb') as f:
+                        f.write(self.header())
+            with open(self.path, 'rb') as f:
+                if f.read(GALLERY_HEADER_SIZE) != self.header():
+                    raise ValueError(f"{self.path} is not a face gallery of this version.")
+            self.sync()
+
+    def manifest_signature(self):
+        # The manifest is replaced atomically on every write, so a new inode or
+        # mtime means another process has changed the gallery.
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def sync(self):
+        # Picks up records other processes appended; rewritten records need no
+        # work since the mapping shows the file's current contents.
+        self.manifest_stat = self.manifest_signature()
+        if self.manifest_stat is not None:
+            with open(self.manifest_path) as f:
+                self.version = json.load(f)["version"]
+        self.remap()
+        for name in self.records["name"][len(self.names):]:
+            self.rows[name.decode("utf-8")] = len(self.names)
+            self.names.append(name.decode("utf-8"))
+
+    def refresh(self):
+        # Called per request: one stat() unless the gallery changed elsewhere.
+        if self.manifest_signature() != self.manifest_stat:
+            with self.lock:
+                self.sync()
+
+    def write_manifest(self):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "users": len(self.names), "updated": time.time()}, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.manifest_stat = self.manifest_signature()
+
+    def header(self):
+        return GALLERY_MAGIC + np.array([GALLERY_VERSION, GALLERY_RECORD.itemsize, 0], "<u4").tobytes()
+
+    def remap(self):
+        # A half-written record at the end (crash during append) is ignored.
+        count = (os.path.getsize(self.path) - GALLERY_HEADER_SIZE) // GALLERY_RECORD.itemsize
+        if count:
+            self.records = np.memmap(self.path, GALLERY_RECORD, 'r', offset=GALLERY_HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, GALLERY_RECORD)
+
+    def add(self, username, face_img, registered=None):
+        record = np.zeros(1, GALLERY_RECORD)
+        record["feature"] = np.sqrt(lbph_histogram(face_img))
+        record["face"] = face_img
+        record["name"] = username.encode("utf-8")
+        record["registered"] = time.time() if registered is None else registered
+        with self.lock, file_lock(self.lock_path):
+            self.sync()
+            row = self.rows.get(username)
+            with open(self.path, 'r+b') as f:
+                if row is None:
+                    # Drop a half-written record left by a crash before appending.
+                    f.truncate(GALLERY_HEADER_SIZE + len(self.names) * GALLERY_RECORD.itemsize)
+                    f.seek(0, os.SEEK_END)
+                else:
+                    f.seek(GALLERY_HEADER_SIZE + row * GALLERY_RECORD.itemsize)
+                f.write(record.tobytes())
+            if row is None:
+                self.rows[username] = len(self.names)
+                self.names.append(username)
+                self.remap()
+            self.version += 1
+            self.write_manifest()
+
+    def face(self, username):
+        with self.lock:
+            row = self.rows.get(username)
+            return None if row is None else np.array(self.records[row]["face"])
+
+    def search(self, face_img, k=TOP_K):
+        # Returns up to k (username, distance) pairs, closest first.
+        return self.search_many([face_img], k)[0]
+
+    def search_many(self, face_imgs, k=TOP_K):
+        # Scores several faces in one pass over the gallery (a matrix-matrix
+        # product instead of one matrix-vector product per face).
+        queries = np.sqrt(np.stack([lbph_histogram(face_img) for face_img in face_imgs]))
+        with self.lock:
+            # Rows are only appended or rewritten in place, so this snapshot
+            # stays valid while the product runs without holding the lock.
+            count = len(self.names)
+            records = self.records
+            names = self.names
+        if not count:
+            return [[] for _ in face_imgs]
+        features = records["feature"][:count]
+        scores = features @ queries.T
+        results = []
+        for query, column in zip(queries, scores.T):
+            candidates = np.argpartition(-column, min(RERANK, count - 1))[:RERANK]
+            a = features[candidates] ** 2
+            b = query ** 2
+            total = a + b
+            distances = (2 * (a - b) ** 2 / np.where(total > 0, total, 1)).sum(axis=1)
+            order = np.argsort(distances)[:k]
+            results.append([(names[candidates[i]], float(distances[i])) for i in order])
+        return results
+
+    def import_pngs(self, directory):
+        # One-off migration from the old layout of one <username>.png per user.
+        imported = skipped = 0
+        for filename in sorted(os.listdir(directory)):
+            username, ext = os.path.splitext(filename)
+            if ext.lower() != ".png":
+                continue
+            img = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_GRAYSCALE)
+            if username in self.rows or img is None or len(username.encode("utf-8")) > MAX_NAME_BYTES:
+                skipped += 1
+                continue
+            if img.shape != (FACE_SIZE, FACE_SIZE):
+                img = cv2.resize(img, (FACE_SIZE, FACE_SIZE))
+            self.add(username, img, os.path.getmtime(os.path.join(directory, filename)))
+            imported += 1
+        return imported, skipped
+
+gallery = FaceGallery(GALLERY_PATH, MANIFEST_PATH, LOCK_PATH)
+gallery.load()
+
+class Camera:
+    # Owns the webcam: a single capture thread publishes the newest frame to
+    # every subscriber and releases the device when the last one leaves.
+    # Frames are shared, so consumers must copy before drawing on them.
+    def __init__(self, index=0):
+        self.index = index
+        self.condition = threading.Condition()
+        self.subscribers = 0
+        self.thread = None
+        self.frame = None
+        self.frame_id = 0
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    @contextmanager
+    def subscription(self):
+        self.subscribe()
+        try:
+            yield self
+        finally:
+            self.unsubscribe()
+
+    def capture_loop(self):
+        cam = cv2.VideoCapture(self.index)
+        while True:
+            ret, frame = cam.read()
+            with self.condition:
+                if self.subscribers == 0:
+                    # Released under the lock so a new subscriber cannot open
+                    # the device before this thread has let go of it.
+                    cam.release()
+                    self.thread = None
+                    self.frame = None
+                    return
+                if ret:
+                    self.frame = frame
+                    self.frame_id += 1
+                    self.condition.notify_all()
+            if not ret:
+                time.sleep(0.1)
+
+    def wait_frame(self, last_id=0, timeout=2.0):
+        # Returns (frame_id, frame) for the first frame newer than last_id, or
+        # (last_id, None) if the camera delivers nothing within the timeout.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frame_id > last_id, timeout):
+                return last_id, None
+            return self.frame_id, self.frame
+
+    def capture(self):
+        with self.subscription():
+            with self.condition:
+                last_id = self.frame_id
+            return self.wait_frame(last_id)[1]
+
+camera = Camera(0)
+
+# Live preview detection runs on frames scaled down to DETECT_WIDTH pixels and
+# only every DETECT_EVERY frames; in between, boxes are tracked.
+DETECT_WIDTH = 320
+DETECT_EVERY = 10
+TRACK_MIN_SCORE = 0.6
+
+class FaceTracker:
+    # One per stream. Each detected face is followed by matching its patch in a
+    # small window around its last position, which costs far less than a full
+    # cascade pass; a face that no longer matches triggers a new detection.
+    def __init__(self):
+        self.boxes = []
+        self.templates = []
+        self.frames_left = 0
+
+    def update(self, frame):
+        # Returns face boxes (x, y, w, h) in full-frame coordinates.
+        scale = min(1.0, DETECT_WIDTH / frame.shape[1])
+        small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.frames_left <= 0 or not self.track(small):
+            self.detect(small)
+        self.frames_left -= 1
+        return [tuple(int(v / scale) for v in box) for box in self.boxes]
+
+    def detect(self, small):
+        self.boxes = [tuple(box) for box in face_cascade.detectMultiScale(small, 1.3, 5)]
+        self.templates = [small[y:y+h, x:x+w].copy() for (x, y, w, h) in self.boxes]
+        self.frames_left = DETECT_EVERY
+
+    def track(self, small):
+        boxes = []
+        for (x, y, w, h), template in zip(self.boxes, self.templates):
+            x0, y0 = max(0, x - w // 2), max(0, y - h // 2)
+            window = small[y0:y + h + h // 2, x0:x + w + w // 2]
+            if window.shape[0] < h or window.shape[1] < w:
+                return False
+            _, score, _, (dx, dy) = cv2.minMaxLoc(cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED))
+            if score < TRACK_MIN_SCORE:
+                return False
+            boxes.append((x0 + dx, y0 + dy, w, h))
+        self.boxes = boxes
+        return True
+
+# Every viewer of the live preview gets the same annotated frames, JPEG-encoded
+# once per frame for each quality in use. Viewers whose connection cannot keep
+# up move to a lower quality; they always get the newest frame, so a slow one
+# simply skips frames instead of queueing them.
+JPEG_QUALITIES = (90, 70, 50)
+SLOW_SEND = 0.05  # seconds a frame may take to go out before quality drops
+FAST_SEND = 0.01  # ...and below which it goes back up
+ADAPT_INTERVAL = 1.0
+
+class FeedViewer:
+    def __init__(self, feed):
+        self.feed = feed
+        self.level = 0
+        self.send_time = 0.0
+        self.changed = time.monotonic()
+
+    @property
+    def quality(self):
+        return JPEG_QUALITIES[self.level]
+
+    def sent(self, elapsed):
+        # elapsed is how long the server took to write the previous frame to
+        # this client, i.e. how much the connection is pushing back.
+        self.send_time = 0.7 * self.send_time + 0.3 * elapsed
+        now = time.monotonic()
+        if now - self.changed < ADAPT_INTERVAL:
+            return
+        if self.send_time > SLOW_SEND and self.level < len(JPEG_QUALITIES) - 1:
+            level = self.level + 1
+        elif self.send_time < FAST_SEND and self.level > 0:
+            level = self.level - 1
+        else:
+            return
+        self.feed.change_quality(self.quality, JPEG_QUALITIES[level])
+        self.level = level
+        self.changed = now
+
+class VideoFeed:
+    def __init__(self, camera):
+        self.camera = camera
+        self.condition = threading.Condition()
+        self.qualities = collections.Counter()
+        self.thread = None
+        self.frame_id = 0
+        self.jpegs = {}
+
+    @contextmanager
+    def viewer(self):
+        viewer = FeedViewer(self)
+        with self.condition:
+            self.qualities[viewer.quality] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.produce, daemon=True)
+                self.thread.start()
+        try:
+            yield viewer
+        finally:
+            self.change_quality(viewer.quality, None)
+
+    def change_quality(self, old, new):
+        with self.condition:
+            self.qualities[old] -= 1
+            if new is not None:
+                self.qualities[new] += 1
+            self.qualities += collections.Counter()  # drops qualities nobody uses
+
+    def wait_jpeg(self, last_id, quality, timeout=2.0):
+        # Returns (frame_id, jpeg bytes) of the newest frame after last_id, or
+        # (last_id, None) when the camera stopped delivering.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frame_id > last_id, timeout) or not self.jpegs:
+                return last_id, None
+            nearest = min(self.jpegs, key=lambda q: abs(q - quality))
+            return self.frame_id, self.jpegs[nearest]
+
+    def produce(self):
+        tracker = FaceTracker()
+        frame_id = 0
+        scan_pos = 0
+        direction = 1  # 1: down, -1: up
+        with self.camera.subscription():
+            while True:
+                with self.condition:
+                    qualities = list(self.qualities)
+                    if not qualities:
+                        self.thread = None
+                        self.jpegs = {}
+                        return
+                frame_id, frame = self.camera.wait_frame(frame_id)
+                jpegs = {}
+                if frame is not None:
+                    frame = frame.copy()
+                    height = frame.shape[0]
+                    for (x, y, w, h) in tracker.update(frame):
+                        cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 193, 7), 2)
+                    # --- SCANNING LINE EFFECT ---
+                    scan_thickness = 3
+                    scan_color = (0, 255, 0)  # Bright green
+                    scan_pos += direction * 6  # speed
+                    if scan_pos >= height - 1:
+                        scan_pos = height - 1
+                        direction = -1
+                    elif scan_pos <= 0:
+                        scan_pos = 0
+                        direction = 1
+                    cv2.line(frame, (0, scan_pos), (frame.shape[1], scan_pos), scan_color, scan_thickness)
+                    for quality in qualities:
+                        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                        if ret:
+                            jpegs[quality] = (b'--frame\r\n'
+                                              b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+                # An empty set of frames tells viewers the camera has failed.
+                with self.condition:
+                    self.frame_id += 1
+                    self.jpegs = jpegs
+                    self.condition.notify_all()
+
+video_feed_hub = VideoFeed(camera)
 
 CAMERA_SOUND_BASE64 = (
     "UklGRhIAAABXQVZFZm10IBAAAAABAAEAQB8AAEAfAAABAAgAZGF0YYAAAP//AAD//wAA//8AAP//AAD//wAA//8AAP//"
@@ -372,6 +841,79 @@ THEME_SCRIPT = """
     </script>
 """
 
+# Shared by the register and login pages: if the browser grants camera access,
+# the page shows the local camera instead of the server's feed and submits a
+# short burst of JPEG frames with the form. Otherwise the form is posted as is
+# and the server captures from its own webcam.
+CAMERA_SCRIPT = """
+    <script>
+        window.browserCamera = null;
+        (function() {
+            var feed = document.getElementById('feed');
+            if (!feed || !navigator.mediaDevices || !navigator.mediaDevices.getUserMedia) return;
+            navigator.mediaDevices.getUserMedia({video: true}).then(function(stream) {
+                var video = document.createElement('video');
+                video.autoplay = true;
+                video.muted = true;
+                video.playsInline = true;
+                video.width = feed.width;
+                video.height = feed.height;
+                video.srcObject = stream;
+                feed.replaceWith(video);
+                window.browserCamera = video;
+            }).catch(function() {});
+        })();
+        function videoReady(video) {
+            // Frames can only be drawn once the video size is known.
+            if (video.readyState >= 1 && video.videoWidth) return Promise.resolve(video);
+            return new Promise(function(resolve) {
+                video.addEventListener('loadedmetadata', function() { resolve(video); }, {once: true});
+            });
+        }
+        function captureBurst(video, count, interval) {
+            var canvas = document.createElement('canvas');
+            canvas.width = video.videoWidth;
+            canvas.height = video.videoHeight;
+            var blobs = [];
+            return new Promise(function(resolve) {
+                (function grab(remaining) {
+                    canvas.getContext('2d').drawImage(video, 0, 0);
+                    canvas.toBlob(function(blob) {
+                        if (blob) blobs.push(blob);
+                        if (remaining <= 1) resolve(blobs);
+                        else setTimeout(function() { grab(remaining - 1); }, interval);
+                    }, 'image/jpeg', 0.9);
+                })(count);
+            });
+        }
+        function submitForm(form) {
+            var video = window.browserCamera;
+            if (!video) { form.submit(); return; }
+            videoReady(video).then(function() {
+                return captureBurst(video, 3, 120);
+            }).then(function(blobs) {
+                if (!blobs.length) throw new Error('No frames captured');
+                var data = new FormData(form);
+                blobs.forEach(function(blob, i) { data.append('frame', blob, 'frame' + i + '.jpg'); });
+                return fetch(window.location.href, {method: 'POST', body: data});
+            }).then(function(response) {
+                if (!response.ok) throw new Error('Upload failed: ' + response.status);
+                return response.text();
+            }).then(function(html) {
+                video.srcObject.getTracks().forEach(function(track) { track.stop(); });
+                document.open();
+                document.write(html);
+                document.close();
+            }).catch(function() {
+                // Upload too large, network error or no frames: let the server
+                // capture from its own webcam (it reports an error if it has none).
+                video.srcObject.getTracks().forEach(function(track) { track.stop(); });
+                form.submit();
+            });
+        }
+    </script>
+"""
+
 INDEX_HTML = """
 <!DOCTYPE html>
 <html>
@@ -469,7 +1011,7 @@ REGISTER_HTML = """
                 audio.currentTime = 0;
                 audio.play();
                 setTimeout(function() {
-                    document.getElementById("registerForm").submit();
+                    submitForm(document.getElementById("registerForm"));
                 }, 400);
             }
         }
@@ -480,7 +1022,7 @@ REGISTER_HTML = """
         });
         </script>
         <p><a href="{{ url_for('index') }}">&larr; Back to Home</a></p>
-        <img src="{{ url_for('video_feed', mode='register') }}" width="320" height="240">
+        <img id="feed" src="{{ url_for('video_feed', mode='register') }}" width="320" height="240">
         {% if capture_status %}
         <p class="{{ 'success' if capture_status == 'success' else 'error' }}">
             {{ capture_message }}
@@ -497,6 +1039,7 @@ REGISTER_HTML = """
         </div>
     </div>
     {{ THEME_SCRIPT|safe }}
+    {{ CAMERA_SCRIPT|safe }}
 </body>
 </html>
 """
@@ -514,10 +1057,16 @@ LOGIN_HTML = """
         <h2>Face Authentication (Login)</h2>
     </header>
     <main>
-        <form method="POST">
+        <form method="POST" id="loginForm">
             <button type="submit">Authenticate with Webcam</button>
         </form>
-        <img src="{{ url_for('video_feed', mode='login') }}" width="320" height="240">
+        <script>
+        document.getElementById('loginForm').addEventListener('submit', function(e) {
+            e.preventDefault();
+            submitForm(this);
+        });
+        </script>
+        <img id="feed" src="{{ url_for('video_feed', mode='login') }}" width="320" height="240">
         {% if registered_img_b64 and current_img_b64 %}
         <div class="sidebyside" style="margin-top:1.2rem;">
             <div>
@@ -547,32 +1096,135 @@ LOGIN_HTML = """
         </div>
     </div>
     {{ THEME_SCRIPT|safe }}
+    {{ CAMERA_SCRIPT|safe }}
 </body>
 </html>
 """
 
-def get_registered_users():
-    return [f.split(".")[0] for f in os.listdir(FACE_DIR) if f.endswith(".png")]
-
-def train_recognizer():
-    images, labels = [], []
-    for user in get_registered_users():
-        img_path = os.path.join(FACE_DIR, f"{user}.png")
-        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-        if img is not None:
-            images.append(img)
-            labels.append(user)
-    if images:
-        label_ids = {name: idx for idx, name in enumerate(labels)}
-        rev_labels = {v: k for k, v in label_ids.items()}
-        recognizer.train(images, np.array([label_ids[l] for l in labels]))
-        return label_ids, rev_labels
+def read_frames():
+    # Decoded frames from the request: multipart "frame" uploads (a burst from
+    # the browser) or a raw image body. Empty if nothing was uploaded.
+    if request.mimetype.startswith("image/"):
+        uploads = [request.get_data()]
     else:
-        return {}, {}
+        uploads = [upload.read() for upload in request.files.getlist("frame")[:MAX_UPLOAD_FRAMES]]
+    frames = [cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) for data in uploads if data]
+    return [frame for frame in frames if frame is not None]
+
+def capture_frames():
+    # Uploaded frames if the client sent any, else one frame from the server's
+    # own webcam (empty list if that fails too).
+    if request.files or request.mimetype.startswith("image/"):
+        return read_frames()
+    frame = camera.capture()
+    return [] if frame is None else [frame]
+
+def best_face(frames):
+    # Returns (face image, number of faces found). Of the frames showing
+    # exactly one face, the sharpest one is used.
+    best, best_sharpness, face_count = None, -1.0, 0
+    for frame in frames:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        if len(faces) != 1:
+            face_count = max(face_count, len(faces))
+            continue
+        (x, y, w, h) = faces[0]
+        face_img = cv2.resize(gray[y:y+h, x:x+w], (FACE_SIZE, FACE_SIZE))
+        sharpness = cv2.Laplacian(face_img, cv2.CV_64F).var()
+        if sharpness > best_sharpness:
+            best, best_sharpness = face_img, sharpness
+    return best, 1 if best is not None else face_count
+
+# Detection runs on a pool of worker threads fed by a bounded queue (OpenCV
+# releases the GIL, so the workers run in parallel), one job per worker at a
+# time. Faces that need matching go on to a single matcher thread, which takes
+# whatever is waiting, up to RECOGNITION_BATCH, and matches them in one search.
+# When the queue is full, requests are turned away instead of piling up.
+RECOGNITION_WORKERS = os.cpu_count() or 1
+RECOGNITION_QUEUE_SIZE = 64
+RECOGNITION_BATCH = 8
+RECOGNITION_TIMEOUT = 10.0
+
+class ServiceBusy(Exception):
+    pass
+
+class RecognitionService:
+    def __init__(self, workers, queue_size, batch_size):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.jobs = queue.Queue(maxsize=queue_size)
+        # At most one face per detection worker is waiting here, so this
+        # needs no bound of its own.
+        self.to_match = queue.Queue()
+        self.threads = []
+        self.start_lock = threading.Lock()
+
+    def submit(self, frames, match=True):
+        # Future of (face image or None, number of faces, matches or None).
+        # match=False only picks the face, as registration needs.
+        with self.start_lock:
+            if not self.threads:
+                targets = [self.detect] * self.workers + [self.match]
+                for target in targets:
+                    thread = threading.Thread(target=target, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        future = concurrent.futures.Future()
+        try:
+            self.jobs.put_nowait((frames, match, future))
+        except queue.Full:
+            raise ServiceBusy("Too many recognition requests are waiting.") from None
+        return future
+
+    def run(self, frames, match=True, timeout=RECOGNITION_TIMEOUT):
+        future = self.submit(frames, match)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ServiceBusy("Recognition timed out.") from None
+
+    def detect(self):
+        while True:
+            frames, match, future = self.jobs.get()
+            # Skips jobs whose caller gave up waiting.
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                face_img, face_count = best_face(frames)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if match and face_img is not None:
+                self.to_match.put((face_img, future))
+            else:
+                future.set_result((face_img, face_count, None))
+
+    def match(self):
+        while True:
+            batch = [self.to_match.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.to_match.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                gallery.refresh()
+                results = gallery.search_many([face_img for face_img, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (face_img, future), matches in zip(batch, results):
+                future.set_result((face_img, 1, matches))
+
+recognition = RecognitionService(RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE, RECOGNITION_BATCH)
 
 @app.route('/')
 def index():
-    users_count = len(get_registered_users())
+    gallery.refresh()
+    users_count = len(gallery)
     last_login = session.get("last_login")
     return render_template_string(
         INDEX_HTML,
@@ -591,26 +1243,31 @@ def register():
     capture_message = ""
     if request.method == "POST":
         username = request.form['username']
-        cam = cv2.VideoCapture(0)
-        ret, frame = cam.read()
-        cam.release()
-        if not ret:
+        too_long = len(username.encode("utf-8")) > MAX_NAME_BYTES
+        frames = [] if too_long else capture_frames()
+        if too_long:
+            capture_status = "fail"
+            capture_message = f"Username is too long (at most {MAX_NAME_BYTES} bytes)."
+        elif not frames:
             capture_status = "fail"
             capture_message = "Webcam error: Could not capture image."
         else:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            if len(faces) != 1:
+            busy = False
+            try:
+                face_img, face_count, _ = recognition.run(frames, match=False)
+            except ServiceBusy:
+                busy = True
+            if busy:
+                capture_status = "fail"
+                capture_message = "The server is busy. Please try again in a moment."
+            elif face_img is None:
                 capture_status = "fail"
-                if len(faces) == 0:
+                if face_count == 0:
                     capture_message = "No face detected. Please try again."
                 else:
                     capture_message = "Multiple faces detected. Please ensure only your face is visible."
             else:
-                (x, y, w, h) = faces[0]
-                face_img = gray[y:y+h, x:x+w]
-                face_img = cv2.resize(face_img, (200, 200))
-                cv2.imwrite(os.path.join(FACE_DIR, f"{username}.png"), face_img)
+                gallery.add(username, face_img)
                 capture_status = "success"
                 capture_message = "Picture captured and saved successfully."
                 message = f"Face registered for {username}."
@@ -619,6 +1276,7 @@ def register():
         message=message,
         BASE_STYLE=BASE_STYLE,
         THEME_SCRIPT=THEME_SCRIPT,
+        CAMERA_SCRIPT=CAMERA_SCRIPT,
         capture_status=capture_status,
         capture_message=capture_message,
         CAMERA_SOUND_BASE64=CAMERA_SOUND_BASE64,
@@ -634,45 +1292,45 @@ def login():
     current_img_b64 = None
     user = None
     if request.method == "POST":
-        cam = cv2.VideoCapture(0)
-        ret, frame = cam.read()
-        cam.release()
-        if not ret:
+        frames = capture_frames()
+        if not frames:
             message = "Webcam error."
         else:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            if len(faces) != 1:
+            busy = False
+            try:
+                face_img, _, matches = recognition.run(frames)
+            except ServiceBusy:
+                busy = True
+            if busy:
+                message = "The server is busy. Please try again in a moment."
+            elif face_img is None:
                 message = "Please ensure exactly one face is visible."
+            elif not matches:
+                message = "No faces registered yet."
             else:
-                (x, y, w, h) = faces[0]
-                face_img = gray[y:y+h, x:x+w]
-                face_img = cv2.resize(face_img, (200, 200))
-                label_ids, rev_labels = train_recognizer()
-                if not label_ids:
-                    message = "No faces registered yet."
+                user, confidence = matches[0]
+                registered_face = gallery.face(user)
+                if registered_face is not None:
+                    _, reg_buf = cv2.imencode(".png", registered_face)
+                    registered_img_b64 = base64.b64encode(reg_buf).decode("utf-8")
+                _, curr_buf = cv2.imencode(".png", face_img)
+                current_img_b64 = base64.b64encode(curr_buf).decode("utf-8")
+                if user and confidence < AUTH_THRESHOLD:
+                    message = f"Authenticated as {user} (confidence: {confidence:.2f})"
+                    session["last_login"] = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+                elif user:
+                    message = f"Face detected as {user}, but authentication failed (confidence: {confidence:.2f})."
+                    if len(matches) > 1:
+                        others = ", ".join(f"{name} ({distance:.2f})" for name, distance in matches[1:])
+                        message += f" Other close matches: {others}."
                 else:
-                    pred_label, confidence_val = recognizer.predict(face_img)
-                    confidence = confidence_val
-                    user = rev_labels.get(pred_label)
-                    registered_img_path = os.path.join(FACE_DIR, f"{user}.png") if user else None
-                    if registered_img_path and os.path.exists(registered_img_path):
-                        with open(registered_img_path, "rb") as f:
-                            registered_img_b64 = base64.b64encode(f.read()).decode("utf-8")
-                    _, curr_buf = cv2.imencode(".png", face_img)
-                    current_img_b64 = base64.b64encode(curr_buf).decode("utf-8")
-                    if user and confidence < 70:
-                        message = f"Authenticated as {user} (confidence: {confidence:.2f})"
-                        session["last_login"] = datetime.now().strftime("%Y-%m-%d %I:%M %p")
-                    elif user:
-                        message = f"Face detected as {user}, but authentication failed (confidence: {confidence:.2f})."
-                    else:
-                        message = "Authentication failed."
+                    message = "Authentication failed."
     return render_template_string(
         LOGIN_HTML,
         message=message,
         BASE_STYLE=BASE_STYLE,
         THEME_SCRIPT=THEME_SCRIPT,
+        CAMERA_SCRIPT=CAMERA_SCRIPT,
         registered_img_b64=registered_img_b64,
         current_img_b64=current_img_b64,
         confidence=confidence,
@@ -680,45 +1338,72 @@ def login():
         github_link=GITHUB_LINK
     )
 
+# JSON endpoints for clients other than the web pages. Both take one or more
+# JPEG frames as multipart "frame" fields (or a single image as the raw body).
+@app.route('/api/register', methods=['POST'])
+def api_register():
+    username = request.form.get("username") or request.args.get("username", "")
+    if not username or len(username.encode("utf-8")) > MAX_NAME_BYTES:
+        return jsonify(error=f"A username of 1 to {MAX_NAME_BYTES} bytes is required."), 400
+    frames = read_frames()
+    if not frames:
+        return jsonify(error="No decodable image uploaded."), 400
+    try:
+        face_img, face_count, _ = recognition.run(frames, match=False)
+    except ServiceBusy as e:
+        return jsonify(error=str(e)), 503
+    if face_img is None:
+        return jsonify(error="Expected exactly one face.", faces=face_count), 422
+    gallery.add(username, face_img)
+    return jsonify(registered=username)
+
+@app.route('/api/login', methods=['POST'])
+def api_login():
+    frames = read_frames()
+    if not frames:
+        return jsonify(error="No decodable image uploaded."), 400
+    try:
+        face_img, face_count, matches = recognition.run(frames)
+    except ServiceBusy as e:
+        return jsonify(error=str(e)), 503
+    if face_img is None:
+        return jsonify(error="Expected exactly one face.", faces=face_count), 422
+    authenticated = bool(matches) and matches[0][1] < AUTH_THRESHOLD
+    if authenticated:
+        session["last_login"] = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+    return jsonify(
+        authenticated=authenticated,
+        user=matches[0][0] if authenticated else None,
+        matches=[{"user": name, "confidence": distance} for name, distance in matches]
+    )
+
 @app.route('/video_feed')
 def video_feed():
     mode = request.args.get('mode')
     def stream():
-        cam = cv2.VideoCapture(0)
-        height = int(cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        scan_pos = 0
-        direction = 1  # 1: down, -1: up
-        while True:
-            ret, frame = cam.read()
-            if not ret:
-                break
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-            for (x, y, w, h) in faces:
-                cv2.rectangle(frame, (x, y), (x+w, y+h), (255, 193, 7), 2)
-            # --- SCANNING LINE EFFECT ---
-            scan_thickness = 3
-            scan_color = (0, 255, 0)  # Bright green
-            scan_pos += direction * 6  # speed
-            if scan_pos >= height - 1:
-                scan_pos = height - 1
-                direction = -1
-            elif scan_pos <= 0:
-                scan_pos = 0
-                direction = 1
-            cv2.line(frame, (0, scan_pos), (frame.shape[1], scan_pos), scan_color, scan_thickness)
-            ret2, buffer = cv2.imencode('.jpg', frame)
-            if not ret2:
-                continue
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        cam.release()
+        # Leaving the with block (camera failure, or the client disconnecting,
+        # which closes this generator) drops the viewer.
+        with video_feed_hub.viewer() as viewer:
+            frame_id = 0
+            while True:
+                frame_id, part = video_feed_hub.wait_jpeg(frame_id, viewer.quality)
+                if part is None:
+                    break
+                started = time.monotonic()
+                yield part
+                viewer.sent(time.monotonic() - started)
     return Response(stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 if __name__ == '__main__':
-    try:
-        _ = cv2.face.LBPHFaceRecognizer_create
-    except AttributeError:
-        print("Please install opencv-contrib-python: pip install opencv-contrib-python")
-        exit(1)
+    parser = argparse.ArgumentParser(description="Web-based facial authentication.")
+    parser.add_argument("command", nargs="?", choices=["run", "migrate"], default="run",
+                        help="run the web app (default), or import registered_faces/*.png into the gallery")
+    args = parser.parse_args()
+    if args.command == "migrate":
+        imported, skipped = gallery.import_pngs(FACE_DIR)
+        print(f"Imported {imported} faces into {GALLERY_PATH}; {skipped} skipped (already imported or unreadable).")
+        sys.exit(0)
+    if not len(gallery) and any(f.endswith(".png") for f in os.listdir(FACE_DIR)):
+        print(f"Found face images in {FACE_DIR}/ but the gallery is empty: "
+              f"run 'python {os.path.basename(__file__)} migrate' to import them.")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file